@@ -0,0 +1,430 @@
+"""
+Async entry point for Marvel.
+
+    gunicorn --preload asgi:app -k uvicorn.workers.UvicornWorker --workers 2 --timeout 120
+
+POST /chat is served here on the event loop with the async OpenAI client, so
+one worker can keep hundreds of students waiting on the model without a thread
+each. Every other route (/, /embed, static, LTI) is handed to the
+regular Flask app through asgiref's WSGI adapter.
+
+Upstream calls go through UpstreamGate: at most UPSTREAM_CONCURRENCY calls in
+flight per worker, the rest wait in strict arrival order (up to
+UPSTREAM_MAX_WAITING of them, for at most UPSTREAM_QUEUE_TIMEOUT seconds).
+"""
+import os
+import json
+import math
+import sqlite3
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from http.cookies import SimpleCookie
+from typing import Dict, Any
+
+from asgiref.wsgi import WsgiToAsgi
+from openai import AsyncOpenAI
+from werkzeug.http import dump_cookie
+
+from marvel_addons.prompts import normalize_level
+
+from app import (
+    app as flask_app,
+    OPENAI_API_KEY,
+    MISSING_KEY_REPLY,
+    RATE_LIMITED_REPLY,
+    EMPTY_REPLY,
+    REQUEST_SECONDS,
+    ROUTE_SECONDS,
+    STAGE_SECONDS,
+    WordCapStream,
+    admit,
+    build_messages,
+    cap_150_words,
+    conversation_id,
+    detect_focus,
+    done_event,
+    flight_key,
+    history_writer,
+    load_history,
+    lookup_reply,
+    persist_turn,
+    record_reply,
+    record_turn,
+    record_usage,
+    remember_reply,
+    route_message,
+    singleflight,
+    sse,
+    upstream_for,
+    upstreams,
+)
+from marvel_addons.http_pool import PoolSettings, async_http_client, awarm
+from marvel_addons.metrics import registry
+from marvel_addons.singleflight import SingleflightError
+from marvel_addons.upstream import StreamBroken
+
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "64"))
+UPSTREAM_MAX_WAITING = int(os.getenv("UPSTREAM_MAX_WAITING", "512"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "60"))
+
+BUSY_REPLY = (
+    "Cariño, en este momento hay muchísimas personas hablando conmigo. "
+    "Espera un minutico y vuelve a intentarlo, por favor."
+)
+
+# One pooled connection per gate slot, warmed on lifespan startup
+apool_settings = PoolSettings.from_env(max_connections=UPSTREAM_CONCURRENCY)
+aclient = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0, timeout=apool_settings.timeout(),
+                      http_client=async_http_client(apool_settings))
+# Same retry/deadline/breaker policy as the Flask path, on the async client
+for upstream in upstreams.values():
+    upstream.aclient = aclient
+
+
+def init_async_process() -> None:
+    """Runs in every forked child (gunicorn --preload): a pool of its own, see app.init_process."""
+    global aclient
+    aclient = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0, timeout=apool_settings.timeout(),
+                          http_client=async_http_client(apool_settings))
+    for u in upstreams.values():
+        u.aclient = aclient
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=init_async_process)
+
+
+# ==================== UPSTREAM GATE ====================
+
+class GateFull(Exception):
+    """Raised when the wait queue is full or the wait timed out."""
+
+
+class UpstreamGate:
+    """
+    FIFO admission to the model: at most `limit` calls in flight, at most
+    `max_waiting` queued behind them. A released slot is handed directly to the
+    oldest waiter, so late arrivals can never overtake someone already queued.
+    """
+
+    def __init__(self, limit: int, max_waiting: int):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.waiters: deque = deque()
+
+    async def acquire(self, timeout: float) -> None:
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        if len(self.waiters) >= self.max_waiting:
+            raise GateFull()
+
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if fut.done() and not fut.cancelled():
+                # The slot was handed over just as we gave up: pass it on.
+                self.release()
+            else:
+                try:
+                    self.waiters.remove(fut)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                raise GateFull() from None
+            raise
+
+    def release(self) -> None:
+        while self.waiters:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)  # slot changes hands, `active` stays the same
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, timeout: float = UPSTREAM_QUEUE_TIMEOUT):
+        await self.acquire(timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, int]:
+        return {"active": self.active, "waiting": len(self.waiters), "limit": self.limit}
+
+
+gate = UpstreamGate(UPSTREAM_CONCURRENCY, UPSTREAM_MAX_WAITING)
+
+
+# ==================== SESSION COOKIE ====================
+# Same signed cookie Flask uses (it only carries the conversation id), so the
+# async /chat and the Flask routes see the same conversation.
+
+def load_session(scope) -> Dict[str, Any]:
+    with STAGE_SECONDS.time(stage="session_cookie"):
+        return _load_session(scope)
+
+
+def _load_session(scope) -> Dict[str, Any]:
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    name = flask_app.config["SESSION_COOKIE_NAME"]
+    for key, value in scope.get("headers", []):
+        if key == b"cookie":
+            jar = SimpleCookie()
+            jar.load(value.decode("latin-1"))
+            if name in jar and serializer is not None:
+                try:
+                    max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+                    return dict(serializer.loads(jar[name].value, max_age=max_age))
+                except Exception:
+                    return {}
+    return {}
+
+
+def session_cookie_header(sess: Dict[str, Any]) -> tuple:
+    iface = flask_app.session_interface
+    serializer = iface.get_signing_serializer(flask_app)
+    with STAGE_SECONDS.time(stage="session_cookie"):
+        cookie = dump_cookie(
+            iface.get_cookie_name(flask_app),
+            serializer.dumps(sess),
+            domain=iface.get_cookie_domain(flask_app),
+            path=iface.get_cookie_path(flask_app),
+            httponly=iface.get_cookie_httponly(flask_app),
+            secure=iface.get_cookie_secure(flask_app),
+            samesite=iface.get_cookie_samesite(flask_app),
+        )
+    return (b"set-cookie", cookie.encode("latin-1"))
+
+
+# ==================== ASGI APP ====================
+
+async def read_json(receive) -> Dict[str, Any]:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def send_json(send, payload: Dict[str, Any], status: int = 200, headers: list = ()) -> None:
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), *headers],
+    })
+    await send({"type": "http.response.body", "body": json.dumps(payload).encode("utf-8")})
+
+
+# The conversation store, response cache, admission buckets and singleflight
+# rows are SQLite files: those steps run in worker threads (asyncio.to_thread)
+# so a lock wait or WAL checkpoint never stalls the other streams on the loop.
+
+async def chat(scope, receive, send) -> None:
+    """Async /chat: same request and response shapes as app.chat."""
+    data = await read_json(receive)
+    user_text = data.get("message", "").strip()
+    level = normalize_level(data.get("level"))
+
+    if not OPENAI_API_KEY:
+        await send_json(send, {"reply": MISSING_KEY_REPLY})
+        return
+
+    sess = load_session(scope)
+    new_session = "cid" not in sess
+    cid = await asyncio.to_thread(conversation_id, sess)
+    cookie = [session_cookie_header(sess)] if new_session else []
+
+    focus = detect_focus(user_text)
+    route = route_message(user_text, focus)
+    scope["route"] = route.name  # for the per-route request time in app()
+    if route.reply is not None:
+        messages, prompt_tokens, cache_key, cached = [], 0, None, route.reply
+    else:
+        summary, history, turn_count = await asyncio.to_thread(load_history, cid)
+        messages, prompt_tokens = build_messages(user_text, level, focus, history, summary)
+
+        cache_key, cached = await asyncio.to_thread(lookup_reply, user_text, level, focus, history, summary)
+
+    if cached is None:
+        retry_after = await asyncio.to_thread(admit, sess, cid, prompt_tokens)
+        if retry_after:
+            wait = str(math.ceil(retry_after))
+            await send_json(send, {"reply": RATE_LIMITED_REPLY, "retry_after": int(wait)}, status=429,
+                            headers=[(b"retry-after", wait.encode()), *cookie])
+            return
+
+    accept = dict(scope.get("headers", [])).get(b"accept", b"")
+    if data.get("stream") or b"text/event-stream" in accept:
+        await stream_chat(send, sess, cookie, messages, cid, user_text, level, focus,
+                          prompt_tokens, cache_key, cached, route)
+        return
+
+    if cached is not None:
+        reply = cached
+    else:
+        try:
+            raw = await coalesced_acall(messages, level, focus, prompt_tokens, route)
+        except (GateFull, SingleflightError):
+            await send_json(send, {"reply": BUSY_REPLY}, status=503)
+            return
+        reply = cap_150_words(raw or "")
+        await asyncio.to_thread(remember_reply, cache_key, reply)
+    turn_count = await asyncio.to_thread(record_turn, cid, user_text, reply)
+    persist_turn(sess, user_text, reply, level, focus)
+    await send_json(send, {"reply": reply, "turn_count": turn_count, "focus": focus},
+                    headers=cookie)
+
+
+async def gated_acall(messages, model) -> str:
+    async with gate.slot():
+        return await upstream_for(model).acall(messages)
+
+
+async def coalesced_acall(messages, level, focus, prompt_tokens, route) -> str:
+    """
+    One gated upstream call per distinct `messages` in flight; followers hold no
+    gate slot. If the shared flights table cannot be used, the call is made alone.
+    """
+    async def lead() -> str:
+        reply = await gated_acall(messages, route.tier.model)
+        record_usage(route, level, focus, prompt_tokens, reply)
+        return reply
+
+    try:
+        return await singleflight.ado(flight_key(messages, route.tier.model), lead)
+    except sqlite3.Error as e:
+        flask_app.logger.warning("singleflight unavailable, calling the model directly: %r", e)
+        return await lead()
+
+
+async def stream_chat(send, sess, cookie, messages, cid, user_text, level, focus,
+                      prompt_tokens, cache_key, cached, route) -> None:
+    """Async twin of app.stream_chat."""
+    if cached is not None:
+        turn_count = await asyncio.to_thread(record_turn, cid, user_text, cached)
+        persist_turn(sess, user_text, cached, level, focus)
+        body = sse({"delta": cached}) + sse(done_event(cached, turn_count, focus))
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache"),
+                *cookie,
+            ],
+        })
+        await send({"type": "http.response.body", "body": body.encode("utf-8")})
+        return
+
+    headers = [
+        (b"content-type", b"text/event-stream; charset=utf-8"),
+        (b"cache-control", b"no-cache"),
+        (b"x-accel-buffering", b"no"),
+        *cookie,
+    ]
+    cap = WordCapStream()
+    complete = True
+    try:
+        lease = await singleflight.alead(flight_key(messages, route.tier.model))
+    except sqlite3.Error:
+        lease = None  # coalesced_acall below then calls the model directly
+    if lease is None:
+        # An identical call is already in flight: send its answer as one delta
+        try:
+            shared = await coalesced_acall(messages, level, focus, prompt_tokens, route)
+        except (GateFull, SingleflightError):
+            await send_json(send, {"reply": BUSY_REPLY}, status=503)
+            return
+        turn_count = await asyncio.to_thread(record_turn, cid, user_text)
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        out = cap.feed(shared)
+        if out:
+            await send({"type": "http.response.body",
+                        "body": sse({"delta": out}).encode("utf-8"), "more_body": True})
+    else:
+        complete = False
+        try:
+            async with gate.slot():
+                turn_count = await asyncio.to_thread(record_turn, cid, user_text)
+                await send({"type": "http.response.start", "status": 200, "headers": headers})
+                deltas = upstream_for(route.tier.model).astream(messages)
+                try:
+                    async for delta in deltas:
+                        out = cap.feed(delta)
+                        if out:
+                            await send({"type": "http.response.body",
+                                        "body": sse({"delta": out}).encode("utf-8"), "more_body": True})
+                        if cap.done:
+                            break
+                    complete = True
+                except StreamBroken:
+                    pass  # the student keeps what arrived; nobody else gets it
+                finally:
+                    await deltas.aclose()
+        except GateFull:
+            await send_json(send, {"reply": BUSY_REPLY}, status=503)
+            return
+        finally:
+            record_usage(route, level, focus, prompt_tokens, cap.text)
+            if complete and cap.text:
+                await lease.apublish(cap.text)
+            else:
+                await lease.aabandon()
+    if complete:
+        await asyncio.to_thread(remember_reply, cache_key, cap.text)
+    await asyncio.to_thread(record_reply, cid, cap.text or EMPTY_REPLY)
+    persist_turn(sess, user_text, cap.text or EMPTY_REPLY, level, focus)
+
+    final = sse(done_event(cap.text, turn_count, focus))
+    await send({"type": "http.response.body", "body": final.encode("utf-8")})
+
+
+async def lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # The worker only starts accepting requests once startup is complete
+            if OPENAI_API_KEY:
+                await awarm(aclient, apool_settings.warm, timeout=2 * apool_settings.connect_timeout)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await aclient.close()
+            # uvicorn re-raises SIGTERM after shutdown, so atexit hooks never run
+            if history_writer is not None:
+                await asyncio.to_thread(history_writer.close)
+            await asyncio.to_thread(registry.flush)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+flask_asgi = WsgiToAsgi(flask_app)
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif scope["type"] == "http" and scope["path"] == "/chat" and scope["method"] == "POST":
+        started = time.perf_counter()
+        try:
+            await chat(scope, receive, send)
+        finally:
+            elapsed = time.perf_counter() - started
+            REQUEST_SECONDS.observe(elapsed, endpoint="chat")
+            if "route" in scope:
+                ROUTE_SECONDS.observe(elapsed, route=scope["route"])
+    else:
+        await flask_asgi(scope, receive, send)
+
@@ -0,0 +1,244 @@
+"""
+Batch evaluation of prompt, focus and model changes over a corpus of messages.
+
+    python bench/batch_eval.py --stub                         # offline, against bench/fake_openai.py
+    python bench/batch_eval.py --concurrency 8 --out /tmp/after.jsonl
+    python bench/batch_eval.py --corpus my_cases.jsonl --no-cache --json summary.json
+
+Each line of the corpus (bench/eval_corpus.jsonl by default) is
+
+    {"id": "a2-fue-era", "level": "A2", "message": "...",
+     "history": [{"role": "user", "content": "..."}, ...],    # optional
+     "focus": "GENERAL",                                       # optional expected label
+     "route": "small"}                                         # optional expected route
+
+and goes through the same steps as /chat: detect_focus, route_message,
+build_messages (SYSTEM_PROMPT, instruction block, history), call_openai on
+the routed model and cap_150_words. Up to --concurrency cases run at once.
+
+Model replies are cached in a SQLite file (--cache) under the hash of the
+model and the exact messages sent, so a rerun only calls the model for
+cases whose prompt changed; --no-cache calls it for every case. Failed
+calls are never cached. --stub starts bench/fake_openai.py on a free port
+and points the OpenAI client at it, so CI needs no network or key (stub
+replies are cached separately from real ones).
+
+Every case is written to --out as one JSON line (reply, words, cap hit,
+focus, route, model latency, cache hit). The summary gives word counts, cap hits,
+focus labels and routes (and disagreements with the corpus) and model latency;
+the exit status is 1 if a focus label or route disagrees or the share of
+failed calls exceeds --max-error-rate. Cases with an expected route keep
+routing.json honest both ways: crisis and personal phrases must reach their
+template, and ordinary sentences that merely contain such words must not.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from load_test import ROOT, free_port, percentile, stop, wait_until_up
+
+CORPUS = os.path.join(ROOT, "bench", "eval_corpus.jsonl")
+CACHE = os.path.join(ROOT, "bench", ".eval_cache.sqlite")
+OUT = os.path.join(ROOT, "bench", "eval_results.jsonl")
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS replies (
+    key TEXT PRIMARY KEY,         -- sha256 of backend:model and the messages
+    reply TEXT NOT NULL,          -- uncapped model reply
+    model_ms REAL NOT NULL,       -- latency of the call that produced it
+    created REAL NOT NULL
+);
+"""
+
+
+class ReplyCache:
+    """Model replies by request hash; one connection per thread."""
+
+    def __init__(self, path: Optional[str], backend: str):
+        self.path = path
+        self.backend = backend
+        self._local = threading.local()
+        if path:
+            self._db().executescript(CACHE_SCHEMA)
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def key(self, model: str, messages: List[Dict[str, Any]]) -> str:
+        from app import flight_key
+        return flight_key(messages, f"{self.backend}:{model}")
+
+    def get(self, key: str):
+        if not self.path:
+            return None
+        return self._db().execute("SELECT reply, model_ms FROM replies WHERE key = ?", (key,)).fetchone()
+
+    def put(self, key: str, reply: str, model_ms: float) -> None:
+        if self.path:
+            self._db().execute("INSERT OR REPLACE INTO replies (key, reply, model_ms, created) VALUES (?, ?, ?, ?)",
+                               (key, reply, model_ms, time.time()))
+
+
+def load_corpus(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+    for i, case in enumerate(cases):
+        case.setdefault("id", str(i + 1))
+    return cases
+
+
+def run_case(case: Dict[str, Any], cache: ReplyCache) -> Dict[str, Any]:
+    from app import (build_messages, call_openai, cap_150_words, detect_focus, normalize_level,
+                     route_message, UPSTREAM_ERROR_REPLIES)
+
+    level = normalize_level(case.get("level"))
+    message = case["message"]
+    focus = detect_focus(message)
+    route = route_message(message, focus)
+    result = {"id": case["id"], "level": level, "message": message, "focus": focus,
+              "expected_focus": case.get("focus"), "route": route.name, "expected_route": case.get("route"),
+              "model": route.tier.model if route.tier else None, "cached": False, "model_ms": None}
+
+    if route.reply is not None:
+        raw = route.reply
+    else:
+        messages, result["prompt_tokens"] = build_messages(message, level, focus, case.get("history", []),
+                                                           case.get("summary", ""))
+        key = cache.key(route.tier.model, messages)
+        hit = cache.get(key)
+        if hit is not None:
+            raw, result["model_ms"] = hit
+            result["cached"] = True
+        else:
+            started = time.perf_counter()
+            raw = call_openai(messages, route.tier.model)
+            result["model_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            if raw in UPSTREAM_ERROR_REPLIES:
+                result["error"] = True
+            else:
+                cache.put(key, raw, result["model_ms"])
+    reply = cap_150_words(raw)
+    result.update(reply=reply, words=len(reply.split()), capped=len(raw.split()) > 150)
+    return result
+
+
+def summarize(results: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    words = [r["words"] for r in results]
+    # Cached replies keep the latency measured when they were produced
+    latencies = [r["model_ms"] for r in results if r["model_ms"] is not None]
+    mismatches = [{"id": r["id"], "expected": r["expected_focus"], "got": r["focus"]}
+                  for r in results if r["expected_focus"] and r["expected_focus"] != r["focus"]]
+    route_mismatches = [{"id": r["id"], "expected": r["expected_route"], "got": r["route"]}
+                        for r in results if r["expected_route"] and r["expected_route"] != r["route"]]
+    return {
+        "cases": len(results),
+        "seconds": round(elapsed, 2),
+        "model_calls": sum(r["model_ms"] is not None and not r["cached"] for r in results),
+        "cache_hits": sum(r["cached"] for r in results),
+        "errors": sum(bool(r.get("error")) for r in results),
+        "words_p50": percentile(words, 50),
+        "words_p95": percentile(words, 95),
+        "words_max": max(words, default=None),
+        "cap_hits": sum(r["capped"] for r in results),
+        "focus": dict(Counter(r["focus"] for r in results)),
+        "focus_by_level": {level: dict(Counter(r["focus"] for r in results if r["level"] == level))
+                           for level in sorted({r["level"] for r in results})},
+        "focus_mismatches": mismatches,
+        "routes": dict(Counter(r["route"] for r in results)),
+        "route_mismatches": route_mismatches,
+        "model_ms_p50": percentile(latencies, 50),
+        "model_ms_p95": percentile(latencies, 95),
+        "model_ms_p99": percentile(latencies, 99),
+    }
+
+
+def print_summary(s: Dict[str, Any]) -> None:
+    print(f"{s['cases']} cases in {s['seconds']} s: {s['model_calls']} model calls, "
+          f"{s['cache_hits']} from cache, {s['errors']} failed")
+    print(f"words: p50 {s['words_p50']}, p95 {s['words_p95']}, max {s['words_max']}; "
+          f"cap hits {s['cap_hits']}")
+    print(f"focus: {s['focus']}")
+    for level, counts in s["focus_by_level"].items():
+        print(f"  {level}: {counts}")
+    print(f"routes: {s['routes']}")
+    print(f"model latency (ms): p50 {s['model_ms_p50']}, p95 {s['model_ms_p95']}, p99 {s['model_ms_p99']}")
+    for m in s["focus_mismatches"]:
+        print(f"focus mismatch {m['id']}: expected {m['expected']}, got {m['got']}")
+    for m in s["route_mismatches"]:
+        print(f"route mismatch {m['id']}: expected {m['expected']}, got {m['got']}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Batch evaluation of the /chat pipeline over a corpus.")
+    parser.add_argument("--corpus", default=CORPUS)
+    parser.add_argument("--out", default=OUT, help="results, one JSON line per case")
+    parser.add_argument("--json", help="also write the summary to this file")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--cache", default=CACHE, help="SQLite file of cached model replies")
+    parser.add_argument("--no-cache", action="store_true", help="call the model for every case")
+    parser.add_argument("--max-error-rate", type=float, default=0.0)
+    stub = parser.add_argument_group("stub model (bench/fake_openai.py)")
+    stub.add_argument("--stub", action="store_true", help="run offline against a local fake OpenAI")
+    stub.add_argument("--stub-latency", default="fixed:0.05")
+    stub.add_argument("--stub-reply-words", type=int, default=120)
+    args = parser.parse_args()
+
+    cases = load_corpus(args.corpus)
+    stub_proc = None
+    if args.stub:
+        port = free_port()
+        stub_proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "bench", "fake_openai.py"),
+                                      "--port", str(port), "--latency", args.stub_latency,
+                                      "--tokens-per-sec", "5000", "--reply-words", str(args.stub_reply_words),
+                                      "--seed", "0"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        os.environ.update(OPENAI_API_KEY="bench", OPENAI_BASE_URL=f"http://127.0.0.1:{port}/v1")
+    # Before importing app: no shared state with a running server, and a pool that fits --concurrency
+    os.environ.setdefault("MARVEL_STATE_DIR", tempfile.mkdtemp(prefix="marvel-eval-"))
+    os.environ["UPSTREAM_POOL_SIZE"] = str(max(args.concurrency, int(os.getenv("UPSTREAM_POOL_SIZE") or 0)))
+    sys.path.insert(0, ROOT)
+    try:
+        if stub_proc is not None:
+            wait_until_up(f"http://127.0.0.1:{port}/stats")
+        import app
+        if not app.OPENAI_API_KEY:
+            print("OPENAI_API_KEY is not set (use --stub to run offline)", file=sys.stderr)
+            return 2
+        backend = f"stub:{args.stub_reply_words}" if args.stub else os.getenv("OPENAI_BASE_URL") or "openai"
+        cache = ReplyCache(None if args.no_cache else args.cache, backend)
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda case: run_case(case, cache), cases))
+        summary = summarize(results, time.monotonic() - started)
+    finally:
+        if stub_proc is not None:
+            stop(stub_proc)
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        for r in results:
+            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    print_summary(summary)
+    print(f"results in {args.out}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+    error_rate = summary["errors"] / max(1, summary["model_calls"])
+    mismatched = summary["focus_mismatches"] or summary["route_mismatches"]
+    return 1 if mismatched or error_rate > args.max_error_rate else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
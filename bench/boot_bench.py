@@ -0,0 +1,199 @@
+"""
+Import-time report and boot benchmark for the app.
+
+    python bench/boot_bench.py                       # import report + check, then boot both configs
+    python bench/boot_bench.py --runs 10 --budget-ms 1500 --no-boot
+
+The import report runs `python -X importtime -c "import app"` --runs times
+in fresh interpreters and prints the median total and the heaviest modules
+app.py imports directly. It is also a check: the exit status is 1 if any
+LAZY_MODULES is imported by `import app` (they belong to the LTI add-on and
+must load on first use, or in create_app() before gunicorn forks) or if the
+median exceeds --budget-ms.
+
+The boot benchmark starts gunicorn with and without --preload and reports
+the time until the first 200 on / and the memory of master plus workers
+(proportional set size, so pages shared copy-on-write after --preload are
+counted once; Linux only). Each server gets a throwaway MARVEL_STATE_DIR
+and DATABASE_URL and no connection warm-up, so only boot work is measured.
+"""
+import argparse
+import json
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+from load_test import ROOT, free_port, stop, wait_until_up
+
+# Must not be imported by `import app`
+LAZY_MODULES = ("sqlalchemy", "pylti1p3", "jwt", "cryptography")
+
+SERVERS = {
+    "per-worker": "gunicorn app:app --workers 2 --threads 8 --timeout 120",
+    "preload": 'gunicorn --preload "app:create_app()" --workers 2 --threads 8 --timeout 120',
+}
+
+
+def bench_env(workdir: str) -> Dict[str, str]:
+    return {
+        **os.environ,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": "http://127.0.0.1:9/v1",  # never called; nothing is warmed
+        "UPSTREAM_POOL_WARM": "0",
+        "MARVEL_STATE_DIR": os.path.join(workdir, "state"),
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'history.db')}",
+        "FLASK_DEBUG": "0",
+    }
+
+
+# ==================== IMPORT TIME ====================
+
+def parse_importtime(stderr: str) -> List[Tuple[int, int, str]]:
+    """(cumulative µs, depth, module) for each `-X importtime` line, in output order."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        rows.append((int(cumulative), depth, name.strip()))
+    return rows
+
+
+def import_once(env: Dict[str, str]) -> Tuple[int, Dict[str, int], List[str]]:
+    """(total µs, {direct import: µs}, every module imported) for one `import app`."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=ROOT, env=env,
+                          capture_output=True, text=True, timeout=120)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import app failed:\n{proc.stderr[-2000:]}")
+    rows = parse_importtime(proc.stderr)
+    # Children are printed before their parent, so app's direct imports are
+    # the depth-1 rows just above the "app" row
+    total, direct = 0, {}
+    for i, (cumulative, depth, name) in enumerate(rows):
+        if depth == 0 and name == "app":
+            total = cumulative
+            for cum, d, child in reversed(rows[:i]):
+                if d == 0:
+                    break
+                if d == 1:
+                    direct[child] = cum
+    return total, direct, [name for _, _, name in rows]
+
+
+def import_report(runs: int, top: int) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="marvel-boot-")
+    env = bench_env(workdir)
+    totals, direct_runs, modules = [], [], set()
+    for _ in range(runs):
+        total, direct, imported = import_once(env)
+        totals.append(total)
+        direct_runs.append(direct)
+        modules.update(imported)
+    names = {name for direct in direct_runs for name in direct}
+    heaviest = sorted(((statistics.median(d.get(n, 0) for d in direct_runs), n) for n in names), reverse=True)
+    return {
+        "runs": runs,
+        "import_ms": round(statistics.median(totals) / 1000, 1),
+        "import_ms_min": round(min(totals) / 1000, 1),
+        "heaviest": [{"module": n, "ms": round(us / 1000, 1)} for us, n in heaviest[:top]],
+        "eager_lazy_modules": sorted(m for m in LAZY_MODULES
+                                     if any(x == m or x.startswith(m + ".") for x in modules)),
+    }
+
+
+# ==================== BOOT ====================
+
+def _children(pid: int) -> List[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(c) for c in f.read().split()]
+    except OSError:
+        return []
+
+
+def _pss_kib(pid: int) -> int:
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                return int(line.split()[1])
+    return 0
+
+
+def memory_mib(master: int) -> Optional[float]:
+    """Proportional set size of gunicorn's master and workers, None where /proc cannot tell."""
+    try:
+        return round(sum(_pss_kib(pid) for pid in [master, *_children(master)]) / 1024, 1)
+    except OSError:
+        return None
+
+
+def boot(name: str, command: str, workers: int) -> Dict:
+    workdir = tempfile.mkdtemp(prefix=f"marvel-boot-{name}-")
+    port = free_port()
+    started = time.monotonic()
+    proc = subprocess.Popen(shlex.split(command) + ["--bind", f"127.0.0.1:{port}"], cwd=ROOT,
+                            env=bench_env(workdir), stdout=subprocess.DEVNULL,
+                            stderr=open(os.path.join(workdir, "server.log"), "w"))
+    try:
+        wait_until_up(f"http://127.0.0.1:{port}/", timeout=60)
+        first_200 = time.monotonic() - started
+        # Wait for every worker before measuring memory
+        deadline = time.monotonic() + 30
+        while len(_children(proc.pid)) < workers and time.monotonic() < deadline:
+            time.sleep(0.1)
+        time.sleep(1)
+        memory = memory_mib(proc.pid)
+    finally:
+        stop(proc)
+    return {"config": name, "first_200_ms": round(first_200 * 1000), "memory_mib": memory, "logs": workdir}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Import-time report and gunicorn boot benchmark.")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters for the import report")
+    parser.add_argument("--top", type=int, default=10, help="heaviest direct imports to list")
+    parser.add_argument("--budget-ms", type=float, help="fail if the median `import app` takes longer")
+    parser.add_argument("--no-boot", action="store_true", help="only the import report")
+    parser.add_argument("--server", action="append", default=[],
+                        help='"name=command" to boot (repeatable); default: per-worker and preload')
+    parser.add_argument("--workers", type=int, default=2, help="workers the commands start (for memory)")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    report = import_report(args.runs, args.top)
+    print(f"import app: {report['import_ms']} ms median, {report['import_ms_min']} ms min "
+          f"({report['runs']} runs)")
+    for item in report["heaviest"]:
+        print(f"  {item['ms']:>8} ms  {item['module']}")
+
+    failures = []
+    if report["eager_lazy_modules"]:
+        failures.append(f"imported at startup: {', '.join(report['eager_lazy_modules'])}")
+    if args.budget_ms is not None and report["import_ms"] > args.budget_ms:
+        failures.append(f"import app took {report['import_ms']} ms, budget {args.budget_ms:g} ms")
+
+    results = {"import": report, "boot": []}
+    if not args.no_boot:
+        servers = dict(s.split("=", 1) for s in args.server) if args.server else SERVERS
+        results["boot"] = [boot(name, cmd, args.workers) for name, cmd in servers.items()]
+        print()
+        for r in results["boot"]:
+            print(f"{r['config']:>12}: first 200 after {r['first_200_ms']} ms, "
+                  f"{r['memory_mib'] if r['memory_mib'] is not None else '?'} MiB PSS, logs in {r['logs']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
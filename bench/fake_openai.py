@@ -0,0 +1,225 @@
+"""
+Local stand-in for the OpenAI endpoints Marvel uses, for offline load tests.
+
+    python bench/fake_openai.py --port 8900 --latency lognormal:0.8:0.4 --error-rate 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=bench gunicorn app:app ...
+
+Serves POST /v1/responses and POST /v1/chat/completions, both plain and
+streaming (SSE, in the same event shapes as the real API), plus GET /stats
+with request counters. Replies are random Spanish-ish text.
+
+Latency (time to first token; plain replies also pay the generation time):
+    fixed:0.5            always 0.5 s
+    uniform:0.2:1.5      uniform between 0.2 and 1.5 s
+    lognormal:0.8:0.4    median 0.8 s, sigma 0.4 (a realistic long tail)
+Generation runs at --tokens-per-sec, one word per token.
+
+Fault injection, each drawn per request: --error-rate answers with a status
+from --error-status (429/500/503 by default); --hang-rate never answers (to
+exercise client timeouts); --break-rate cuts a stream halfway. --no-responses
+answers 404 on /v1/responses, like accounts without the Responses API.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+
+WORDS = (
+    "hola cariño vamos a pensar juntas en tu frase el verbo ser estar tiempo pretérito "
+    "imperfecto subjuntivo conector además sin embargo porque ejemplo intenta escribir "
+    "otra vez con tus palabras qué quieres decir aquí mira la concordancia del sujeto"
+).split()
+
+
+def parse_latency(spec: str):
+    kind, *args = spec.split(":")
+    args = [float(a) for a in args]
+    if kind == "fixed":
+        return lambda: args[0]
+    if kind == "uniform":
+        return lambda: random.uniform(args[0], args[1])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(args[0]), args[1])
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+
+class FakeOpenAI:
+    """Raw ASGI app (same style as asgi.py)."""
+
+    def __init__(self, latency="lognormal:0.8:0.4", tokens_per_sec=80.0, reply_words=120,
+                 error_rate=0.0, error_status=(429, 500, 503), hang_rate=0.0, break_rate=0.0,
+                 no_responses=False):
+        self.latency = parse_latency(latency)
+        self.tokens_per_sec = tokens_per_sec
+        self.reply_words = reply_words
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.hang_rate = hang_rate
+        self.break_rate = break_rate
+        self.no_responses = no_responses
+        self.stats = {"requests": 0, "responses": 0, "chat": 0, "stream": 0,
+                      "errors": 0, "hangs": 0, "breaks": 0, "in_flight": 0, "peak_in_flight": 0}
+
+    # --- helpers ---
+
+    def _reply(self):
+        return [random.choice(WORDS) + " " for _ in range(self.reply_words)]
+
+    @staticmethod
+    async def _send_json(send, status, payload):
+        body = json.dumps(payload).encode()
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+
+    @staticmethod
+    async def _read(receive):
+        body = b""
+        while True:
+            msg = await receive()
+            body += msg.get("body", b"")
+            if not msg.get("more_body"):
+                return json.loads(body or b"{}")
+
+    def _usage(self, n):
+        return {"input_tokens": 2000, "output_tokens": n, "total_tokens": 2000 + n,
+                "prompt_tokens": 2000, "completion_tokens": n}
+
+    def _response_obj(self, model, text, status="completed"):
+        return {
+            "id": "resp_" + uuid.uuid4().hex, "object": "response", "created_at": int(time.time()),
+            "model": model, "status": status, "parallel_tool_calls": True, "tool_choice": "auto",
+            "tools": [], "usage": self._usage(len(text.split())),
+            "output": [{"type": "message", "id": "msg_1", "status": "completed", "role": "assistant",
+                        "content": [{"type": "output_text", "text": text, "annotations": []}]}],
+        }
+
+    # --- endpoints ---
+
+    async def _responses(self, body, send, words):
+        model = body.get("model", "fake")
+        if not body.get("stream"):
+            await asyncio.sleep(len(words) / self.tokens_per_sec)
+            await self._send_json(send, 200, self._response_obj(model, "".join(words).strip()))
+            return
+
+        async def events():
+            created = self._response_obj(model, "", "in_progress")
+            yield "response.created", {"type": "response.created", "sequence_number": 0, "response": created}
+            for i, w in enumerate(words, 1):
+                yield "response.output_text.delta", {
+                    "type": "response.output_text.delta", "sequence_number": i, "item_id": "msg_1",
+                    "output_index": 0, "content_index": 0, "delta": w, "logprobs": []}
+            yield "response.completed", {"type": "response.completed", "sequence_number": len(words) + 1,
+                                         "response": self._response_obj(model, "".join(words).strip())}
+        await self._stream(send, events(), done_marker=False)
+
+    async def _chat(self, body, send, words):
+        model = body.get("model", "fake")
+        base = {"id": "chatcmpl-" + uuid.uuid4().hex, "created": int(time.time()), "model": model}
+        if not body.get("stream"):
+            await asyncio.sleep(len(words) / self.tokens_per_sec)
+            await self._send_json(send, 200, {
+                **base, "object": "chat.completion", "usage": self._usage(len(words)),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(words).strip()}}]})
+            return
+
+        async def events():
+            for w in words:
+                yield None, {**base, "object": "chat.completion.chunk",
+                             "choices": [{"index": 0, "delta": {"content": w}, "finish_reason": None}]}
+            yield None, {**base, "object": "chat.completion.chunk",
+                         "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        await self._stream(send, events(), done_marker=True)
+
+    async def _stream(self, send, events, done_marker):
+        self.stats["stream"] += 1
+        cut = random.random() < self.break_rate
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream")]})
+        sent = 0
+        async for name, data in events:
+            if cut and sent >= self.reply_words // 2:
+                self.stats["breaks"] += 1
+                await send({"type": "http.response.body", "body": b""})
+                return
+            chunk = (f"event: {name}\n" if name else "") + f"data: {json.dumps(data)}\n\n"
+            await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+            sent += 1
+            await asyncio.sleep(1 / self.tokens_per_sec)
+        await send({"type": "http.response.body", "body": b"data: [DONE]\n\n" if done_marker else b""})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                msg = await receive()
+                await send({"type": msg["type"] + ".complete"})
+                if msg["type"] == "lifespan.shutdown":
+                    return
+        path = scope["path"]
+        if scope["method"] == "GET" and path == "/stats":
+            await self._send_json(send, 200, self.stats)
+            return
+        if path not in ("/v1/responses", "/v1/chat/completions"):
+            await self._send_json(send, 404, {"error": {"message": "not found"}})
+            return
+
+        body = await self._read(receive)
+        self.stats["requests"] += 1
+        if path == "/v1/responses" and self.no_responses:
+            await self._send_json(send, 404, {"error": {"message": "Responses API not enabled"}})
+            return
+        self.stats["responses" if path == "/v1/responses" else "chat"] += 1
+
+        self.stats["in_flight"] += 1
+        self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.stats["in_flight"])
+        try:
+            roll = random.random()
+            if roll < self.hang_rate:
+                self.stats["hangs"] += 1
+                await asyncio.sleep(3600)
+            await asyncio.sleep(self.latency())
+            if roll < self.hang_rate + self.error_rate:
+                self.stats["errors"] += 1
+                status = random.choice(self.error_status)
+                await self._send_json(send, status, {"error": {"message": f"injected {status}", "type": "server_error"}})
+                return
+            words = self._reply()
+            if path == "/v1/responses":
+                await self._responses(body, send, words)
+            else:
+                await self._chat(body, send, words)
+        finally:
+            self.stats["in_flight"] -= 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI server for offline load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", default="lognormal:0.8:0.4")
+    parser.add_argument("--tokens-per-sec", type=float, default=80.0)
+    parser.add_argument("--reply-words", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", default="429,500,503")
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--break-rate", type=float, default=0.0)
+    parser.add_argument("--no-responses", action="store_true")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    import uvicorn
+    app = FakeOpenAI(args.latency, args.tokens_per_sec, args.reply_words, args.error_rate,
+                     tuple(int(s) for s in args.error_status.split(",")), args.hang_rate,
+                     args.break_rate, args.no_responses)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
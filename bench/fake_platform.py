@@ -0,0 +1,106 @@
+"""
+Local stand-in for the LMS side of an LTI 1.3 launch.
+
+Serves the platform JWKS over HTTP (optionally slow, to mimic a round trip to
+Brightspace) and signs id_tokens with its current key. rotate() swaps in a
+new key the way a platform does when it rotates, so the tool's kid-refresh
+path can be exercised.
+
+    python bench/fake_platform.py --port 8765 --latency 0.25   # serve forever
+
+or import it: FakePlatform(latency=...).start() returns the JWKS URL.
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+from jwcrypto.jwk import JWK
+
+ISSUER = "https://platform.example"
+CLIENT_ID = "marvel-bench"
+DEPLOYMENT_ID = "bench-deployment"
+
+
+class FakePlatform:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self.latency = latency
+        self.requests = 0
+        self._keys = []
+        self.rotate()
+        platform = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                platform.requests += 1
+                if platform.latency:
+                    time.sleep(platform.latency)
+                body = json.dumps(platform.jwks()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self.server.server_address[1]}/.well-known/jwks.json"
+
+    def start(self) -> str:
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self) -> None:
+        self.server.shutdown()
+
+    def rotate(self) -> str:
+        """Signs with a fresh key from now on; the old one stays published."""
+        key = JWK.generate(kty="RSA", size=2048, kid=uuid.uuid4().hex)
+        self._keys.append(key)
+        return key.key_id
+
+    def jwks(self):
+        keys = []
+        for key in self._keys:
+            public = json.loads(key.export_public())
+            public.update(alg="RS256", use="sig")
+            keys.append(public)
+        return {"keys": keys}
+
+    def id_token(self, nonce: str, sub: str = "student-1", context_id: str = "course-1",
+                 roles=("http://purl.imsglobal.org/vocab/lis/v2/membership#Learner",)) -> str:
+        key = self._keys[-1]
+        now = int(time.time())
+        body = {
+            "iss": ISSUER,
+            "aud": CLIENT_ID,
+            "sub": sub,
+            "name": sub.title(),
+            "nonce": nonce,
+            "iat": now,
+            "exp": now + 300,
+            "https://purl.imsglobal.org/spec/lti/claim/deployment_id": DEPLOYMENT_ID,
+            "https://purl.imsglobal.org/spec/lti/claim/message_type": "LtiResourceLinkRequest",
+            "https://purl.imsglobal.org/spec/lti/claim/version": "1.3.0",
+            "https://purl.imsglobal.org/spec/lti/claim/resource_link": {"id": "marvel"},
+            "https://purl.imsglobal.org/spec/lti/claim/context": {"id": context_id},
+            "https://purl.imsglobal.org/spec/lti/claim/roles": list(roles),
+        }
+        return jwt.encode(body, key.export_to_pem(private_key=True, password=None),
+                          algorithm="RS256", headers={"kid": key.key_id})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per JWKS request")
+    args = parser.parse_args()
+    platform = FakePlatform(args.host, args.port, args.latency)
+    print(f"JWKS at {platform.url} (iss={ISSUER}, client_id={CLIENT_ID}, deployment_id={DEPLOYMENT_ID})")
+    platform.server.serve_forever()
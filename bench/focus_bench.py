@@ -0,0 +1,94 @@
+"""
+Regression corpus + micro-benchmark for detect_focus.
+
+    python bench/focus_bench.py            # check the corpus, then time it
+    python bench/focus_bench.py --scale 500
+
+Every line of focus_corpus.jsonl is {"text": ..., "focus": ...}; the script
+exits with status 1 if any label disagrees with detect_focus. The timing
+compares the compiled detector with the old `kw in text` loop, both called
+directly (app.detect_focus also records a stage-timer sample, which is timed
+on its own line), on the shipped keyword list and on one padded to --scale
+entries (to mimic A1–B2 topic lists).
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench-offline")
+
+from app import FOCUS_KEYWORDS, detect_focus, focus_detector  # noqa: E402
+from marvel_addons.focus import FocusDetector, GRAMMAR, GENERAL  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "focus_corpus.jsonl")
+
+
+def substring_detect(keywords, text):
+    """The original detector, kept here as the baseline."""
+    t = text.lower()
+    for kw in keywords:
+        if kw in t:
+            return GRAMMAR
+    return GENERAL
+
+
+def check_corpus():
+    failures = 0
+    with open(CORPUS, encoding="utf-8") as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+    for case in cases:
+        got = detect_focus(case["text"])
+        if got != case["focus"]:
+            failures += 1
+            print(f"MISMATCH  expected={case['focus']:<22} got={got:<22} {case['text']!r}")
+    print(f"corpus: {len(cases) - failures}/{len(cases)} correct")
+    return cases, failures
+
+
+def bench(label, fn, texts, number):
+    seconds = timeit.timeit(lambda: [fn(t) for t in texts], number=number)
+    per_call = seconds / (number * len(texts)) * 1e6
+    print(f"{label:<40} {per_call:8.2f} µs/message")
+    return per_call
+
+
+def verdict(old, new):
+    if new <= old:
+        return f"  compiled regex is {old / new:.1f}x faster"
+    return f"  compiled regex is {new / old:.1f}x slower"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=int, default=400, help="size of the padded keyword list")
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    cases, failures = check_corpus()
+    texts = [c["text"] for c in cases] + [" ".join(c["text"] for c in cases)]
+
+    plain = [kw.rstrip("*") for kw in FOCUS_KEYWORDS]
+    padded = dict(FOCUS_KEYWORDS)
+    for i in range(max(0, args.scale - len(padded))):
+        padded[f"tema{i} nivel{i % 4}"] = 1
+    padded_plain = [kw.rstrip("*") for kw in padded]
+    padded_detector = FocusDetector(padded)
+
+    print(f"\n{len(FOCUS_KEYWORDS)} keywords (shipped)")
+    old = bench("  substring loop (old)", lambda t: substring_detect(plain, t), texts, args.number)
+    new = bench("  compiled regex", focus_detector.detect, texts, args.number)
+    print(verdict(old, new))
+    bench("  app.detect_focus (+ stage timer)", detect_focus, texts, args.number)
+    print(f"{len(padded)} keywords")
+    old = bench("  substring loop (old)", lambda t: substring_detect(padded_plain, t), texts, args.number)
+    new = bench("  compiled regex", padded_detector.detect, texts, args.number)
+    print(verdict(old, new))
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+"""
+Offline load test for /chat against a local fake OpenAI (bench/fake_openai.py).
+
+    python bench/load_test.py                                 # Procfile setup vs asgi, 20 users, 30 s
+    python bench/load_test.py --users 50 --duration 60 --latency lognormal:1.2:0.5
+    python bench/load_test.py --server "sync4=gunicorn app:app --workers 4 --threads 8"
+    python bench/load_test.py --url http://127.0.0.1:5000     # an app you started yourself
+
+For each server configuration the script starts the fake upstream and the
+app (with throwaway MARVEL_STATE_DIR / DATABASE_URL, rate limits and the
+response cache off), then runs --users virtual students for --duration
+seconds. Each student replays a session from bench/sessions.jsonl turn by
+turn, keeping its session cookie (so history builds up as in class), with
+exponential think time between turns. The cookie starts out as an LTI launch
+(signed with --secret-key), since only launched students' turns are saved; --stream-ratio of the sessions use
+SSE. The report gives throughput, p50/p95/p99 latency (and time to first
+delta for streams), upstream calls, and how many turns reached the history
+database, so regressions in /chat, detect_focus or the persistence path show
+up before a term starts. --json writes the same numbers for CI; the exit
+status is 1 if any configuration's error rate exceeds --max-error-rate.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from marvel_addons.upstream import UNAVAILABLE_REPLY, EMPTY_REPLY  # noqa: E402
+
+SESSIONS = os.path.join(ROOT, "bench", "sessions.jsonl")
+SERVERS = {
+    "procfile": 'gunicorn --preload "app:create_app()" --workers 2 --threads 8 --timeout 120',
+    "asgi": "gunicorn --preload asgi:app -k uvicorn.workers.UvicornWorker --workers 2 --timeout 120",
+}
+
+
+@dataclass
+class Sample:
+    status: int
+    latency: float
+    ttft: Optional[float]
+    stream: bool
+    degraded: bool  # 200, but the fallback reply instead of a model answer
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def wait_until_up(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f} s")
+
+
+def stop(proc: subprocess.Popen) -> None:
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+# ==================== LOAD GENERATOR ====================
+
+async def one_turn(client: httpx.AsyncClient, base: str, cookie: Optional[str], text: str,
+                   level: str, stream: bool):
+    """POSTs one /chat turn; returns (Sample, cookie to carry on)."""
+    headers = {"Cookie": cookie} if cookie else {}
+    payload = {"message": text, "level": level, "stream": stream}
+    started = time.perf_counter()
+    ttft, reply = None, ""
+    async with client.stream("POST", base + "/chat", json=payload, headers=headers) as resp:
+        if resp.headers.get("content-type", "").startswith("text/event-stream"):
+            async for line in resp.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[6:])
+                if ttft is None and event.get("delta"):
+                    ttft = time.perf_counter() - started
+                if event.get("done"):
+                    reply = event.get("reply", "")
+        else:
+            body = await resp.aread()
+            try:
+                reply = json.loads(body).get("reply", "")
+            except ValueError:
+                reply = ""
+        # The session cookie is Secure, so carry it by hand over plain http
+        set_cookie = resp.headers.get("set-cookie")
+        if set_cookie:
+            cookie = set_cookie.split(";", 1)[0]
+    sample = Sample(resp.status_code, time.perf_counter() - started, ttft, stream,
+                    reply in (UNAVAILABLE_REPLY, EMPTY_REPLY, ""))
+    return sample, cookie
+
+
+def lti_cookie(secret_key: str, user: int) -> str:
+    """Session cookie of a student after an LTI launch, signed like the app's."""
+    from flask import Flask
+    signer = Flask(__name__)
+    signer.secret_key = secret_key
+    token = signer.session_interface.get_signing_serializer(signer).dumps({
+        "lti_user_id": f"load-{user}", "lti_user_name": f"Student {user}",
+        "lti_user_role": "Learner", "lti_course_id": f"load-course-{user % 4}"})
+    return f"{signer.config['SESSION_COOKIE_NAME']}={token}"
+
+
+async def student(client, base, sessions, samples, stop_at, think, stream_ratio, rng, launch):
+    while time.monotonic() < stop_at:
+        session = rng.choice(sessions)
+        stream = rng.random() < stream_ratio
+        cookie = launch
+        for text in session["turns"]:
+            if time.monotonic() >= stop_at:
+                return
+            try:
+                sample, cookie = await one_turn(client, base, cookie, text, session["level"], stream)
+            except httpx.HTTPError:
+                sample = Sample(599, 0.0, None, stream, True)
+            samples.append(sample)
+            if think:
+                await asyncio.sleep(min(rng.expovariate(1 / think), think * 5))
+
+
+async def run_load(base: str, users: int, duration: float, think: float, stream_ratio: float,
+                   seed: int, secret_key: str) -> List[Sample]:
+    with open(SESSIONS, encoding="utf-8") as f:
+        sessions = [json.loads(line) for line in f if line.strip()]
+    samples: List[Sample] = []
+    limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        stop_at = time.monotonic() + duration
+        await asyncio.gather(*[
+            student(client, base, sessions, samples, stop_at, think, stream_ratio, random.Random(seed + i),
+                    lti_cookie(secret_key, i))
+            for i in range(users)
+        ])
+    return samples
+
+
+def summarize(name: str, samples: List[Sample], elapsed: float, **extra):
+    ok = [s for s in samples if s.status == 200 and not s.degraded]
+    latencies = [s.latency for s in ok]
+    ttfts = [s.ttft for s in ok if s.ttft is not None]
+
+    def ms(v):
+        return None if v is None else round(v * 1000)
+
+    return {
+        "config": name,
+        "requests": len(samples),
+        "ok": len(ok),
+        "errors": len(samples) - len(ok),
+        "error_rate": round((len(samples) - len(ok)) / len(samples), 4) if samples else 0.0,
+        "statuses": {str(c): sum(1 for s in samples if s.status == c) for c in sorted({s.status for s in samples})},
+        "rps": round(len(ok) / elapsed, 2),
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "ttft_p50_ms": ms(percentile(ttfts, 50)),
+        "ttft_p95_ms": ms(percentile(ttfts, 95)),
+        **extra,
+    }
+
+
+# ==================== ORCHESTRATION ====================
+
+def bench_server(name, command, fake_url, args):
+    workdir = tempfile.mkdtemp(prefix=f"marvel-load-{name}-")
+    db_path = os.path.join(workdir, "history.db")
+    port = free_port()
+    env = {
+        **os.environ,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": fake_url + "/v1",
+        "MARVEL_STATE_DIR": os.path.join(workdir, "state"),
+        "DATABASE_URL": f"sqlite:///{db_path}",
+        "SECRET_KEY": args.secret_key,
+        "RESPONSE_CACHE_TTL": os.environ.get("RESPONSE_CACHE_TTL", "3600" if args.cache else "0"),
+        "RATE_STUDENT_REQUESTS_PER_MIN": "0",
+        "RATE_STUDENT_TOKENS_PER_MIN": "0",
+        "RATE_COURSE_REQUESTS_PER_MIN": "0",
+        "RATE_COURSE_TOKENS_PER_MIN": "0",
+        "FLASK_DEBUG": "0",
+    }
+    proc = subprocess.Popen(shlex.split(command) + ["--bind", f"127.0.0.1:{port}"], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=open(os.path.join(workdir, "server.log"), "w"))
+    base = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_up(base + "/")
+        before = httpx.get(fake_url + "/stats").json()
+        started = time.monotonic()
+        samples = asyncio.run(run_load(base, args.users, args.duration, args.think,
+                                       args.stream_ratio, args.seed, args.secret_key))
+        elapsed = time.monotonic() - started
+        upstream_calls = httpx.get(fake_url + "/stats").json()["requests"] - before["requests"]
+    finally:
+        stop(proc)  # workers flush the history queue on exit
+
+    persisted = None
+    if os.path.exists(db_path):
+        with sqlite3.connect(db_path) as db:
+            persisted = db.execute("SELECT count(*) FROM messages").fetchone()[0]
+    return summarize(name, samples, elapsed, upstream_calls=upstream_calls,
+                     persisted_messages=persisted, expected_messages=2 * sum(s.status == 200 for s in samples),
+                     logs=workdir)
+
+
+def print_table(results) -> None:
+    cols = ["config", "requests", "error_rate", "rps", "p50_ms", "p95_ms", "p99_ms",
+            "ttft_p50_ms", "ttft_p95_ms", "upstream_calls", "persisted_messages", "expected_messages"]
+    widths = [max(len(c), *(len(str(r.get(c))) for r in results)) for c in cols]
+    print("  ".join(c.rjust(w) for c, w in zip(cols, widths)))
+    for r in results:
+        print("  ".join(str(r.get(c)).rjust(w) for c, w in zip(cols, widths)))
+    for r in results:
+        print(f"{r['config']}: statuses {r['statuses']}" + (f", logs in {r['logs']}" if r.get("logs") else ""))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline /chat load test.")
+    parser.add_argument("--server", action="append", default=[],
+                        help='"name=command" to benchmark (repeatable); default: procfile and asgi')
+    parser.add_argument("--url", help="load an already running app instead of starting servers")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--think", type=float, default=1.0, help="mean seconds between a student's turns")
+    parser.add_argument("--stream-ratio", type=float, default=0.5)
+    parser.add_argument("--cache", action="store_true", help="leave the response cache on")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--secret-key", default=os.getenv("SECRET_KEY", "dev-secret"),
+                        help="the app's SECRET_KEY, to sign the students' LTI session cookies")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--json", help="also write the results to this file")
+    fake = parser.add_argument_group("fake upstream (see bench/fake_openai.py)")
+    fake.add_argument("--latency", default="lognormal:0.8:0.4")
+    fake.add_argument("--tokens-per-sec", type=float, default=80.0)
+    fake.add_argument("--error-rate", type=float, default=0.0)
+    fake.add_argument("--break-rate", type=float, default=0.0)
+    fake.add_argument("--no-responses", action="store_true")
+    args = parser.parse_args()
+
+    if args.url:
+        started = time.monotonic()
+        samples = asyncio.run(run_load(args.url.rstrip("/"), args.users, args.duration, args.think,
+                                       args.stream_ratio, args.seed, args.secret_key))
+        results = [summarize(args.url, samples, time.monotonic() - started)]
+    else:
+        servers = dict(s.split("=", 1) for s in args.server) if args.server else SERVERS
+        fake_port = free_port()
+        fake_cmd = [sys.executable, os.path.join(ROOT, "bench", "fake_openai.py"), "--port", str(fake_port),
+                    "--latency", args.latency, "--tokens-per-sec", str(args.tokens_per_sec),
+                    "--error-rate", str(args.error_rate), "--break-rate", str(args.break_rate),
+                    "--seed", str(args.seed)] + (["--no-responses"] if args.no_responses else [])
+        fake_proc = subprocess.Popen(fake_cmd)
+        fake_url = f"http://127.0.0.1:{fake_port}"
+        try:
+            wait_until_up(fake_url + "/stats")
+            results = [bench_server(name, cmd, fake_url, args) for name, cmd in servers.items()]
+        finally:
+            stop(fake_proc)
+
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0 if all(r["error_rate"] <= args.max_error_rate for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
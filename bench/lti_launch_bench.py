@@ -0,0 +1,112 @@
+"""
+LTI launch benchmark against a local stand-in platform (bench/fake_platform.py).
+
+    python bench/lti_launch_bench.py                       # 150 launches, 250 ms JWKS
+    python bench/lti_launch_bench.py --launches 300 --latency 0.5
+
+Runs the full OIDC login + launch flow through the Flask test client, first
+with the platform JWKS cache disabled (one fetch per launch, the old
+behaviour) and then with it enabled. Halfway through the cached run the
+platform rotates its key, which must cost exactly one extra fetch. Exits with
+status 1 if any launch fails.
+"""
+import argparse
+import html
+import os
+import statistics
+import sys
+import time
+import types
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives import serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import rsa  # noqa: E402
+from flask import Flask  # noqa: E402
+
+from fake_platform import FakePlatform, ISSUER, CLIENT_ID, DEPLOYMENT_ID  # noqa: E402
+
+
+def install_settings(jwks_url: str) -> None:
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    sys.modules["settings"] = types.SimpleNamespace(
+        PLATFORM_ISSUER=ISSUER,
+        CLIENT_ID=CLIENT_ID,
+        DEPLOYMENT_ID=DEPLOYMENT_ID,
+        OIDC_AUTH_ENDPOINT="https://platform.example/auth",
+        OIDC_TOKEN_ENDPOINT="https://platform.example/token",
+        PLATFORM_JWKS_URL=jwks_url,
+        TOOL_JWKS_URL="http://localhost/lti/jwks",
+        TOOL_REDIRECT_URI="http://localhost/lti/launch",
+        TOOL_INITIATE_LOGIN_URI="http://localhost/lti/login",
+        TOOL_PRIVATE_KEY_PEM=key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        ).decode(),
+    )
+
+
+def launch_once(client, platform, i: int) -> float:
+    started = time.perf_counter()
+    resp = client.get("/lti/login", query_string={
+        "iss": ISSUER, "login_hint": f"student-{i}", "target_link_uri": "http://localhost/lti/launch"})
+    # /lti/login answers with a JS redirect (window.location="...") or a 302
+    location = resp.headers.get("Location") or resp.get_data(as_text=True).split('"')[-2]
+    query = parse_qs(urlparse(html.unescape(location)).query)
+    state, nonce = query["state"][0], query["nonce"][0]
+    resp = client.post("/lti/launch", data={"state": state, "id_token": platform.id_token(nonce, f"student-{i}")})
+    if resp.status_code != 200:
+        raise RuntimeError(f"launch {i} failed: {resp.status_code} {resp.get_data(as_text=True)[:200]}")
+    return time.perf_counter() - started
+
+
+def run(app, platform, lti_keys, launches: int, ttl: float, rotate_at=None):
+    jwks = lti_keys.platform(platform.url)
+    jwks.ttl, jwks.keys, jwks.fetched_at = ttl, None, 0.0
+    before = platform.requests
+    times = []
+    for i in range(launches):
+        if i == rotate_at:
+            platform.rotate()
+        with app.test_client() as client:
+            times.append(launch_once(client, platform, i))
+    times.sort()
+    return {
+        "p50_ms": round(statistics.median(times) * 1000, 1),
+        "p95_ms": round(times[int(len(times) * 0.95) - 1] * 1000, 1),
+        "jwks_fetches": platform.requests - before,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--launches", type=int, default=150)
+    parser.add_argument("--latency", type=float, default=0.25, help="seconds per platform JWKS request")
+    args = parser.parse_args()
+
+    platform = FakePlatform(latency=args.latency)
+    install_settings(platform.start())
+    from marvel_addons.lti_blueprint import lti_bp, lti_keys
+
+    lti_keys = lti_keys()
+
+    app = Flask(__name__, template_folder="../templates")
+    app.secret_key = "bench"
+    app.register_blueprint(lti_bp, url_prefix="/lti")
+
+    jwks = app.test_client().get("/lti/jwks").get_json()
+    print(f"tool JWKS: {len(jwks['keys'])} key(s), kid={jwks['keys'][0].get('kid') if jwks['keys'] else None}")
+    try:
+        uncached = run(app, platform, lti_keys, args.launches, ttl=0)
+        cached = run(app, platform, lti_keys, args.launches, ttl=3600, rotate_at=args.launches // 2)
+    except RuntimeError as e:
+        print(e)
+        return 1
+    print(f"{args.launches} launches, JWKS latency {args.latency * 1000:.0f} ms")
+    print(f"  no cache:  {uncached}")
+    print(f"  cached:    {cached}  (includes one key rotation)")
+    return 0 if cached["jwks_fetches"] == 2 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
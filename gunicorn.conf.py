@@ -0,0 +1,27 @@
+"""
+gunicorn hooks, read automatically from the working directory by both the
+Procfile command and the asgi.py command in the README.
+"""
+import logging
+
+log = logging.getLogger("gunicorn.error")
+
+
+def on_starting(server):
+    """Drops the previous run's metric rows: /metrics counts from this server's start."""
+    from marvel_addons.metrics import registry
+    registry.clear()
+
+
+def post_fork(server, worker):
+    """Opens the new worker's model API connections before it takes requests."""
+    if "uvicorn" in server.cfg.worker_class_str.lower():
+        return  # asgi.py warms its async client on lifespan startup
+
+    from app import OPENAI_API_KEY, client, pool_settings
+    if server.cfg.threads + 1 > pool_settings.max_connections:
+        log.warning("UPSTREAM_POOL_SIZE=%d is below --threads %d plus the summarizer; "
+                    "requests will queue for connections", pool_settings.max_connections, server.cfg.threads)
+    if OPENAI_API_KEY:
+        from marvel_addons.http_pool import warm
+        warm(client, pool_settings.warm, timeout=2 * pool_settings.connect_timeout)
@@ -0,0 +1,106 @@
+"""
+Admission control in front of the model: token buckets per student and per course.
+
+Each student (the LTI user, or the conversation id outside the LMS) and each
+LTI course has two buckets, one counting requests and one counting estimated
+tokens (prompt + the longest reply we allow). Buckets refill continuously at
+their per-minute rate and hold at most one minute's worth, so short bursts
+are fine but sustained overuse is not. A request is admitted only if every
+bucket it touches can pay; otherwise nothing is charged and the caller gets
+how long to wait.
+
+The buckets live in a shared SQLite file (see shared_state), and each check
+is one short write transaction, so all gunicorn workers enforce the same
+limits. A limit of 0 disables that bucket.
+"""
+import random
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from .shared_state import connect
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    level REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+@dataclass
+class Decision:
+    allowed: bool
+    retry_after: float = 0.0
+    bucket: Optional[str] = None  # which limit was hit, for logs
+
+
+class AdmissionControl:
+    def __init__(self, name: str = "admission",
+                 student_requests: float = 6, student_tokens: float = 24000,
+                 course_requests: float = 120, course_tokens: float = 400000):
+        self.name = name
+        # per-minute limits by (scope, unit)
+        self.limits = {
+            ("student", "requests"): student_requests,
+            ("student", "tokens"): student_tokens,
+            ("course", "requests"): course_requests,
+            ("course", "tokens"): course_tokens,
+        }
+        self.rejected = 0
+
+    def _db(self):
+        return connect(self.name, SCHEMA)
+
+    def _charges(self, student: str, course: Optional[str], tokens: int) -> List[Tuple[str, float, float]]:
+        """(bucket key, per-minute limit, cost) for every enabled bucket of this request."""
+        charges = []
+        for scope, key in (("student", student), ("course", course)):
+            if key is None:
+                continue
+            for unit, cost in (("requests", 1), ("tokens", tokens)):
+                limit = self.limits[(scope, unit)]
+                if limit > 0:
+                    # A single oversized request can still get through once the bucket is full
+                    charges.append((f"{scope}:{unit}:{key}", limit, min(cost, limit)))
+        return charges
+
+    def admit(self, student: str, course: Optional[str], tokens: int) -> Decision:
+        charges = self._charges(student, course, tokens)
+        if not charges:
+            return Decision(True)
+        db = self._db()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            keys = [c[0] for c in charges]
+            rows: Dict[str, Tuple[float, float]] = {
+                k: (level, updated) for k, level, updated in db.execute(
+                    f"SELECT key, level, updated_at FROM buckets WHERE key IN ({','.join('?' * len(keys))})",
+                    keys)
+            }
+            levels = []
+            worst = Decision(True)
+            for key, limit, cost in charges:
+                level, updated = rows.get(key, (limit, now))
+                level = min(limit, level + (now - updated) * limit / 60.0)
+                if level < cost:
+                    wait = (cost - level) * 60.0 / limit
+                    if wait > worst.retry_after:
+                        worst = Decision(False, wait, key.rsplit(":", 1)[0])
+                levels.append((key, level - cost))
+            if worst.allowed:
+                db.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, level, updated_at) VALUES (?, ?, ?)",
+                    [(key, level, now) for key, level in levels])
+            # A bucket untouched for a minute is full again, i.e. the same as no row
+            if random.random() < 0.01:
+                db.execute("DELETE FROM buckets WHERE updated_at < ?", (now - 60,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        if not worst.allowed:
+            self.rejected += 1
+        return worst
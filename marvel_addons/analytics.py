@@ -0,0 +1,92 @@
+"""
+Course analytics rollups.
+
+The history writer calls add_turns() in the same transaction as the Message
+insert, so DailyActivity always matches the message table without ever
+scanning it. course_summary() answers /lti/analytics/course from the rollups
+alone.
+"""
+from collections import defaultdict
+from datetime import date, timedelta
+
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .models import DailyActivity, User
+
+COUNTERS = ("turns", "general_turns", "grammar_turns", "a1_turns", "a2_turns", "b1_turns", "b2_turns")
+_FOCUS_COLUMN = {"GENERAL": "general_turns", "GRAMMAR_OR_IMPROVEMENT": "grammar_turns"}
+_LEVEL_COLUMN = {"A1": "a1_turns", "A2": "a2_turns", "B1": "b1_turns", "B2": "b2_turns"}
+
+
+def add_turns(db, turns):
+    """turns: iterable of (course_pk, user_pk, day, level, focus), one per student message."""
+    deltas = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+    for course_pk, user_pk, day, level, focus in turns:
+        row = deltas[(course_pk, user_pk, day)]
+        row["turns"] += 1
+        if focus in _FOCUS_COLUMN:
+            row[_FOCUS_COLUMN[focus]] += 1
+        if level in _LEVEL_COLUMN:
+            row[_LEVEL_COLUMN[level]] += 1
+
+    dialect = db.get_bind().dialect.name
+    for (course_pk, user_pk, day), counts in deltas.items():
+        values = dict(course_id=course_pk, user_id=user_pk, day=day, **counts)
+        if dialect in ("sqlite", "postgresql"):
+            dialect_insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+            stmt = dialect_insert(DailyActivity).values(**values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["course_id", "user_id", "day"],
+                set_={c: getattr(DailyActivity, c) + getattr(stmt.excluded, c) for c in COUNTERS},
+            )
+            db.execute(stmt)
+        else:
+            updated = db.execute(
+                update(DailyActivity)
+                .where(DailyActivity.course_id == course_pk, DailyActivity.user_id == user_pk,
+                       DailyActivity.day == day)
+                .values({c: getattr(DailyActivity, c) + n for c, n in counts.items()})
+            )
+            if updated.rowcount == 0:
+                db.add(DailyActivity(**values))
+
+
+def course_summary(db, course_pk, days=30):
+    since = date.today() - timedelta(days=days - 1)
+    in_window = (DailyActivity.course_id == course_pk, DailyActivity.day >= since)
+    sums = [func.sum(getattr(DailyActivity, c)).label(c) for c in COUNTERS]
+
+    totals = db.execute(select(*sums).where(*in_window)).one()
+
+    per_day = db.execute(
+        select(DailyActivity.day, func.sum(DailyActivity.turns))
+        .where(*in_window).group_by(DailyActivity.day).order_by(DailyActivity.day)
+    ).all()
+
+    per_student = db.execute(
+        select(User.lms_user_id, User.name, *sums, func.max(DailyActivity.day).label("last_day"))
+        .join(User, User.id == DailyActivity.user_id)
+        .where(*in_window)
+        .group_by(User.id, User.lms_user_id, User.name)
+        .order_by(func.sum(DailyActivity.turns).desc())
+    ).all()
+
+    def counts(row):
+        return {
+            "turns": row.turns or 0,
+            "focus": {"GENERAL": row.general_turns or 0, "GRAMMAR_OR_IMPROVEMENT": row.grammar_turns or 0},
+            "levels": {"A1": row.a1_turns or 0, "A2": row.a2_turns or 0,
+                       "B1": row.b1_turns or 0, "B2": row.b2_turns or 0},
+        }
+
+    return {
+        "since": since.isoformat(),
+        "days": days,
+        **counts(totals),
+        "turns_per_day": [{"day": str(d), "turns": n} for d, n in per_day],
+        "students": [
+            {"lms_user_id": r.lms_user_id, "name": r.name, "last_active": str(r.last_day), **counts(r)}
+            for r in per_student
+        ],
+    }
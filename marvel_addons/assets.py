@@ -0,0 +1,269 @@
+"""
+Static assets with content-hashed names, immutable caching and
+precompressed / resized variants.
+
+The build step writes everything under static/dist/ plus a manifest:
+
+    python -m marvel_addons.assets          # after changing anything in static/
+
+- every file gets a copy named after its content (app.css ->
+  dist/app.3f9c2a1b.css), so a changed file gets a new URL and old ones can
+  be cached forever;
+- text files (css, js, svg, ...) also get .gz and, with the `brotli`
+  package, .br siblings, compressed once at maximum level;
+- the images in RESPONSIVE_IMAGES get resized AVIF, WebP and JPEG variants
+  (needs Pillow; AVIF needs Pillow 11.2+ or pillow-avif-plugin) that
+  base.html offers through <picture>/srcset. Without them the page leaves
+  the portrait out rather than send the full-size original.
+
+At runtime StaticAssets rewrites url_for("static", filename="app.css") to the
+hashed name and serves hashed files with `Cache-Control: public,
+max-age=31536000, immutable`, picking the .br or .gz variant the browser
+accepts. Without a build (no manifest) the hashes are computed from static/
+at startup, so cache busting and immutable caching still work, just without
+precompression or the portrait. Unhashed URLs keep Flask's default
+handling (revalidated through ETag).
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from flask import Flask, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+mimetypes.add_type("image/avif", ".avif")
+mimetypes.add_type("image/webp", ".webp")
+
+DIST = "dist"
+MANIFEST = "manifest.json"
+ONE_YEAR = 365 * 24 * 3600
+
+COMPRESSIBLE = {".css", ".js", ".mjs", ".svg", ".json", ".txt", ".html", ".xml", ".map"}
+# Encodings in order of preference, with the suffix of their precompressed file
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+# Source image -> widths (px) to generate; the header shows the portrait at
+# 96 CSS px, so 96/192/288 cover 1x-3x screens
+RESPONSIVE_IMAGES = {
+    "image/marvel-moreno.jpg": (96, 192, 288),
+}
+IMAGE_FORMATS = (("image/avif", ".avif", "AVIF", {"quality": 50}),
+                 ("image/webp", ".webp", "WEBP", {"quality": 75, "method": 6}),
+                 ("image/jpeg", ".jpg", "JPEG", {"quality": 80, "optimize": True, "progressive": True}))
+
+
+def fingerprint(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:8]
+
+
+def hashed_name(name: str, digest: str) -> str:
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{digest}{ext}"
+
+
+def _sources(static_dir: str) -> List[str]:
+    """Files under static_dir (posix-style relative paths), skipping the build output."""
+    names = []
+    for root, dirs, files in os.walk(static_dir):
+        rel_root = os.path.relpath(root, static_dir)
+        if rel_root == ".":
+            dirs[:] = [d for d in dirs if d != DIST]
+        for f in files:
+            if not f.startswith("."):
+                names.append(os.path.normpath(os.path.join(rel_root, f)).replace(os.sep, "/"))
+    return sorted(names)
+
+
+# ==================== BUILD ====================
+
+def _compress(path: str) -> List[str]:
+    """Writes .gz (and .br) next to `path` when they are smaller; returns the encodings written."""
+    with open(path, "rb") as f:
+        data = f.read()
+    variants = [("gzip", ".gz", gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.insert(0, ("br", ".br", brotli.compress(data, quality=11)))
+    written = []
+    for encoding, suffix, body in variants:
+        if len(body) < len(data):
+            with open(path + suffix, "wb") as f:
+                f.write(body)
+            written.append(encoding)
+    return written
+
+
+def _resize(static_dir: str, out_dir: str, name: str, widths) -> Dict[str, List[Tuple[str, int]]]:
+    """Resized variants of one image: {mime type: [(url path, width), ...]}."""
+    variants: Dict[str, List[Tuple[str, int]]] = {}
+    with Image.open(os.path.join(static_dir, name)) as original:
+        original = original.convert("RGB")
+        stem = os.path.splitext(name)[0]
+        for width in sorted({min(w, original.width) for w in widths}):
+            height = round(original.height * width / original.width)
+            img = original.resize((width, height), Image.LANCZOS)
+            for mime, ext, fmt, options in IMAGE_FORMATS:
+                tmp = os.path.join(out_dir, f"{stem}-{width}w{ext}")
+                os.makedirs(os.path.dirname(tmp), exist_ok=True)
+                try:
+                    img.save(tmp, fmt, **options)
+                except (KeyError, OSError, ValueError):
+                    # this Pillow build cannot write `fmt` (usually AVIF)
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    continue
+                final = hashed_name(tmp, fingerprint(tmp))
+                os.replace(tmp, final)
+                rel = os.path.relpath(final, static_dir).replace(os.sep, "/")
+                variants.setdefault(mime, []).append((rel, width))
+    return variants
+
+
+def build(static_dir: str) -> Dict:
+    """Rebuilds static_dir/dist and its manifest; returns the manifest."""
+    out_dir = os.path.join(static_dir, DIST)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    manifest: Dict = {"files": {}, "encodings": {}, "images": {}}
+    for name in _sources(static_dir):
+        src = os.path.join(static_dir, name)
+        rel = f"{DIST}/{hashed_name(name, fingerprint(src))}"
+        dst = os.path.join(static_dir, rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copyfile(src, dst)
+        manifest["files"][name] = rel
+        if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+            encodings = _compress(dst)
+            if encodings:
+                manifest["encodings"][rel] = encodings
+    if Image is not None:
+        for name, widths in RESPONSIVE_IMAGES.items():
+            if name in manifest["files"]:
+                manifest["images"][name] = _resize(static_dir, out_dir, name, widths)
+    with open(os.path.join(out_dir, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+# ==================== RUNTIME ====================
+
+@dataclass
+class ResponsiveImage:
+    """What base.html needs for one <picture>: modern-format sources, then the fallback <img>."""
+    src: str
+    srcset: str = ""
+    sources: List[Dict[str, str]] = field(default_factory=list)
+
+
+class StaticAssets:
+    def __init__(self, app: Optional[Flask] = None):
+        self.urls: Dict[str, str] = {}                 # logical name -> hashed url path
+        self.files: Dict[str, Tuple[str, List[str]]] = {}  # hashed url path -> (file, encodings)
+        self.images: Dict[str, Dict[str, List]] = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        self.static_dir = app.static_folder
+        manifest_path = os.path.join(self.static_dir, DIST, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            for name, rel in manifest["files"].items():
+                self.urls[name] = rel
+                self.files[rel] = (rel, manifest["encodings"].get(rel, []))
+            self.images = manifest["images"]
+            for variants in self.images.values():
+                for items in variants.values():
+                    for rel, _ in items:
+                        self.files[rel] = (rel, [])
+        else:
+            for name in _sources(self.static_dir):
+                rel = hashed_name(name, fingerprint(os.path.join(self.static_dir, name)))
+                self.urls[name] = rel
+                self.files[rel] = (name, [])
+            app.logger.info("no %s/%s; run `python -m marvel_addons.assets` for precompressed "
+                            "and resized assets", DIST, MANIFEST)
+
+        self._send_static = app.view_functions["static"]
+        app.view_functions["static"] = self.serve
+        app.url_defaults(self.hashed_url)
+        app.jinja_env.globals["responsive_image"] = self.responsive_image
+
+    def hashed_url(self, endpoint: str, values: Dict) -> None:
+        if endpoint == "static" and values.get("filename") in self.urls:
+            values["filename"] = self.urls[values["filename"]]
+
+    def serve(self, filename: str):
+        entry = self.files.get(filename)
+        if entry is None:
+            return self._send_static(filename=filename)
+        path, encodings = entry
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        for encoding, suffix in ENCODINGS:
+            if encoding in encodings and request.accept_encodings[encoding]:
+                resp = send_from_directory(self.static_dir, path + suffix, mimetype=mimetype, max_age=ONE_YEAR)
+                resp.headers["Content-Encoding"] = encoding
+                break
+        else:
+            resp = send_from_directory(self.static_dir, path, mimetype=mimetype, max_age=ONE_YEAR)
+        if encodings:
+            resp.vary.add("Accept-Encoding")
+        resp.cache_control.immutable = True
+        return resp
+
+    def responsive_image(self, name: str) -> Optional[ResponsiveImage]:
+        """<picture> data for `name`, or None until the build has resized it (the original is too big to send)."""
+        variants = self.images.get(name)
+        if not variants:
+            return None
+
+        def srcset(items) -> str:
+            return ", ".join(f"{url_for('static', filename=rel)} {width}w" for rel, width in items)
+
+        fallback = variants.get("image/jpeg") or [[self.urls[name], 0]]
+        return ResponsiveImage(
+            src=url_for("static", filename=fallback[0][0]),
+            srcset=srcset(fallback) if len(fallback) > 1 else "",
+            sources=[{"type": mime, "srcset": srcset(variants[mime])}
+                     for mime, _, _, _ in IMAGE_FORMATS if mime != "image/jpeg" and variants.get(mime)],
+        )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Build hashed, precompressed and resized static assets.")
+    parser.add_argument("--static", default=os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), "static"), help="static folder (default: the app's static/)")
+    args = parser.parse_args(argv)
+
+    manifest = build(args.static)
+    print(f"{len(manifest['files'])} files, {len(manifest['encodings'])} precompressed, "
+          f"{sum(len(v) for img in manifest['images'].values() for v in img.values())} image variants "
+          f"in {os.path.join(args.static, DIST)}")
+    if brotli is None:
+        print("brotli is not installed: only gzip variants were written", file=sys.stderr)
+    if Image is None:
+        print("Pillow is not installed: no resized images were written", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,178 @@
+"""
+Server-side conversation store for /chat.
+
+The session cookie only carries an opaque conversation id; the rolling
+history and turn counter live here, one row per conversation in a shared
+SQLite file (see shared_state), so every gunicorn worker sees the same
+conversation. History is stored compactly as zlib-compressed JSON pairs
+([["u", text], ["a", text], ...]) and capped at `max_messages`.
+Conversations idle for `ttl` seconds expire, and the least recently used are
+evicted once there are more than `max_conversations`.
+
+Turns are appended with extend()/append(), each one short write transaction,
+so concurrent writers (the request path and the summarizer in memory.py)
+never overwrite each other. `summary` holds the running summary of the
+messages that have left the front of `history`, and `folded` counts them; it
+doubles as a version number for fold().
+"""
+import json
+import random
+import secrets
+import sqlite3
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import List, Dict, Tuple
+
+from .shared_state import connect
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    history BLOB NOT NULL,
+    turn_count INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    summary TEXT NOT NULL DEFAULT '',
+    folded INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_conversations_updated_at ON conversations (updated_at);
+"""
+
+# Columns added after the first release; older state files get them on connect
+_ADDED_COLUMNS = {
+    "summary": "TEXT NOT NULL DEFAULT ''",
+    "folded": "INTEGER NOT NULL DEFAULT 0",
+}
+
+_ROLES = {"user": "u", "assistant": "a"}
+_ROLE_NAMES = {v: k for k, v in _ROLES.items()}
+
+
+def pack(history: List[Dict[str, str]]) -> bytes:
+    pairs = [[_ROLES.get(h["role"], "u"), h["content"]] for h in history]
+    return zlib.compress(json.dumps(pairs, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def unpack(blob: bytes) -> List[Dict[str, str]]:
+    return [{"role": _ROLE_NAMES[r], "content": c} for r, c in json.loads(zlib.decompress(blob))]
+
+
+@dataclass
+class Conversation:
+    history: List[Dict[str, str]] = field(default_factory=list)
+    turn_count: int = 0
+    summary: str = ""
+    folded: int = 0  # messages no longer in `history` (summarized or trimmed)
+
+
+class ConversationStore:
+    def __init__(self, name: str = "conversations", max_messages: int = 10,
+                 ttl: float = 7 * 24 * 3600, max_conversations: int = 20000):
+        self.name = name
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.max_conversations = max_conversations
+        self._upgraded = False
+
+    def _db(self):
+        db = connect(self.name, SCHEMA)
+        if not self._upgraded:
+            have = {row[1] for row in db.execute("PRAGMA table_info(conversations)")}
+            for column, ddl in _ADDED_COLUMNS.items():
+                if column not in have:
+                    try:
+                        db.execute(f"ALTER TABLE conversations ADD COLUMN {column} {ddl}")
+                    except sqlite3.OperationalError:
+                        pass  # another worker added it first
+            self._upgraded = True
+        return db
+
+    @staticmethod
+    def new_id() -> str:
+        return secrets.token_urlsafe(16)
+
+    def _get(self, db, cid: str) -> Conversation:
+        row = db.execute(
+            "SELECT history, turn_count, updated_at, summary, folded FROM conversations WHERE id = ?", (cid,)
+        ).fetchone()
+        if row is None or row[2] < time.time() - self.ttl:
+            return Conversation()
+        return Conversation(unpack(row[0]), row[1], row[3], row[4])
+
+    def get(self, cid: str) -> Conversation:
+        """The conversation; unknown or expired ids start empty."""
+        return self._get(self._db(), cid)
+
+    def load(self, cid: str) -> Tuple[List[Dict[str, str]], int]:
+        """Returns (history, turn_count); unknown or expired ids start empty."""
+        conversation = self.get(cid)
+        return conversation.history, conversation.turn_count
+
+    def save(self, cid: str, history: List[Dict[str, str]], turn_count: int) -> None:
+        """Replaces the whole conversation (used to import cookie-era history)."""
+        self._db().execute(
+            "INSERT OR REPLACE INTO conversations (id, history, turn_count, updated_at) VALUES (?, ?, ?, ?)",
+            (cid, pack(history[-self.max_messages:]), turn_count, time.time()),
+        )
+        self._maybe_evict()
+
+    def extend(self, cid: str, messages: List[Dict[str, str]], turns: int = 0) -> int:
+        """Appends `messages` and adds `turns` to the turn counter; returns the new count."""
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            conversation = self._get(db, cid)
+            history = conversation.history + messages
+            dropped = max(0, len(history) - self.max_messages)
+            turn_count = conversation.turn_count + turns
+            db.execute(
+                "INSERT OR REPLACE INTO conversations (id, history, turn_count, updated_at, summary, folded) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (cid, pack(history[dropped:]), turn_count, time.time(),
+                 conversation.summary, conversation.folded + dropped),
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        self._maybe_evict()
+        return turn_count
+
+    def append(self, cid: str, role: str, content: str) -> None:
+        self.extend(cid, [{"role": role, "content": content}])
+
+    def fold(self, cid: str, folded: int, count: int, summary: str) -> bool:
+        """
+        Replaces the first `count` messages with `summary`, but only if the
+        front of the history is still where the caller saw it (`folded`
+        unchanged); False when it moved and nothing was written.
+        """
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            conversation = self._get(db, cid)
+            ok = conversation.folded == folded and len(conversation.history) >= count
+            if ok:
+                db.execute(
+                    "UPDATE conversations SET history = ?, summary = ?, folded = ? WHERE id = ?",
+                    (pack(conversation.history[count:]), summary, folded + count, cid),
+                )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return ok
+
+    def _maybe_evict(self) -> None:
+        # Eviction is an index walk, so only do it on ~1% of writes
+        if random.random() < 0.01:
+            self.evict()
+
+    def evict(self) -> None:
+        db = self._db()
+        db.execute("DELETE FROM conversations WHERE updated_at < ?", (time.time() - self.ttl,))
+        db.execute(
+            "DELETE FROM conversations WHERE id IN "
+            "(SELECT id FROM conversations ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_conversations,),
+        )
@@ -0,0 +1,163 @@
+"""
+Constant-memory export of course transcripts (CSV or JSONL, optionally gzip).
+
+Rows are read in keyset pages of BATCH_SIZE along the (course_id, ts, id)
+index, encoded as they arrive and handed out in ~64 KB chunks, so memory
+stays flat however large the course is. Each page is one short read on its
+own connection, released before the page is sent: a slow download never
+holds a transaction open, so the history writer's commits are not blocked
+on the (non-WAL) main database. The generator does not use the request's
+session and can outlive the view function.
+
+Served by /lti/export/course; also runnable from the command line:
+
+    python -m marvel_addons.export --course <lms_course_id> [--format jsonl]
+        [--since 2026-01-01] [--until 2026-06-30] [--student <lms_user_id>]
+        [--gzip] [-o transcripts.csv.gz]
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import zlib
+from datetime import date, datetime, time, timedelta
+from typing import Iterator, Optional
+
+from sqlalchemy import and_, or_, select
+
+from .models import engine, Course, Message, User
+
+FORMATS = {"csv": "text/csv; charset=utf-8", "jsonl": "application/x-ndjson"}
+COLUMNS = ("id", "ts", "lms_user_id", "user_name", "role", "level", "focus", "content")
+BATCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_day(value: Optional[str], end: bool = False) -> Optional[datetime]:
+    """'2026-03-01' -> start of that day, or start of the next one when end=True (bounds are inclusive)."""
+    if not value:
+        return None
+    if "T" in value or " " in value:
+        return datetime.fromisoformat(value)
+    day = date.fromisoformat(value)
+    if end:
+        day += timedelta(days=1)
+    return datetime.combine(day, time.min)
+
+
+def _query(course_pk: int, since=None, until=None, user_pk=None):
+    # Oldest first along ix_messages_course_ts_id
+    stmt = (
+        select(Message.id, Message.ts, User.lms_user_id, User.name, Message.role,
+               Message.level, Message.focus, Message.content)
+        .outerjoin(User, User.id == Message.user_id)
+        .where(Message.course_id == course_pk)
+        .order_by(Message.ts, Message.id)
+    )
+    if since is not None:
+        stmt = stmt.where(Message.ts >= since)
+    if until is not None:
+        stmt = stmt.where(Message.ts < until)
+    if user_pk is not None:
+        stmt = stmt.where(Message.user_id == user_pk)
+    return stmt
+
+
+def rows(course_pk: int, since=None, until=None, user_pk=None) -> Iterator[tuple]:
+    stmt = _query(course_pk, since, until, user_pk)
+    last = None
+    while True:
+        page = stmt.limit(BATCH_SIZE)
+        if last is not None:
+            ts, msg_id = last[1], last[0]
+            if ts is None:
+                # NULL timestamps sort first; past them, every dated row follows
+                after = or_(Message.ts.isnot(None), Message.id > msg_id)
+            else:
+                after = or_(Message.ts > ts, and_(Message.ts == ts, Message.id > msg_id))
+            page = page.where(after)
+        with engine.connect() as conn:
+            batch = conn.execute(page).all()
+        yield from batch
+        if len(batch) < BATCH_SIZE:
+            return
+        last = batch[-1]
+
+
+def _encode(fmt: str, records: Iterator[tuple]) -> Iterator[str]:
+    """Text chunks of roughly CHUNK_SIZE characters."""
+    buf = io.StringIO()
+    if fmt == "csv":
+        writer = csv.writer(buf)
+        writer.writerow(COLUMNS)
+        write = writer.writerow
+    else:
+        def write(record):
+            buf.write(json.dumps(dict(zip(COLUMNS, record)), ensure_ascii=False))
+            buf.write("\n")
+    for rec in records:
+        write((rec[0], rec[1].isoformat() if rec[1] else "", *rec[2:]))
+        if buf.tell() >= CHUNK_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def stream(course_pk: int, fmt: str = "csv", since=None, until=None, user_pk=None,
+           compress: bool = False) -> Iterator[bytes]:
+    """The export as a stream of bytes (a complete .gz file when compress=True)."""
+    chunks = (c.encode("utf-8") for c in _encode(fmt, rows(course_pk, since, until, user_pk)))
+    if not compress:
+        yield from chunks
+        return
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        out = gz.compress(chunk)
+        if out:
+            yield out
+    yield gz.flush()
+
+
+def filename(lms_course_id: str, fmt: str, compress: bool) -> str:
+    safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in lms_course_id) or "course"
+    return f"marvel-{safe}-{date.today().isoformat()}.{fmt}" + (".gz" if compress else "")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Export a course's Marvel transcripts.")
+    parser.add_argument("--course", required=True, help="LMS course id (the LTI context id)")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="csv")
+    parser.add_argument("--since", help="first day (YYYY-MM-DD), inclusive")
+    parser.add_argument("--until", help="last day (YYYY-MM-DD), inclusive")
+    parser.add_argument("--student", help="only this LMS user id")
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("-o", "--output", help="file to write (default: stdout)")
+    args = parser.parse_args(argv)
+
+    with engine.connect() as conn:
+        course_pk = conn.execute(
+            select(Course.id).where(Course.lms_course_id == args.course)).scalar()
+        user_pk = None
+        if args.student:
+            user_pk = conn.execute(
+                select(User.id).where(User.lms_user_id == args.student)).scalar()
+    if course_pk is None or (args.student and user_pk is None):
+        print("No such course or student.", file=sys.stderr)
+        return 1
+
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in stream(course_pk, args.format, parse_day(args.since),
+                            parse_day(args.until, end=True), user_pk, args.gzip):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
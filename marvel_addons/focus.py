@@ -0,0 +1,103 @@
+"""
+Single-pass focus detector.
+
+All keywords are folded (lowercase, no accents) and compiled once into one
+regex with word boundaries. The alternation is factored into a character trie
+("pret(?:erito|...)"), so the engine never re-tries shared prefixes and the
+cost stays flat as the list grows. A message is scanned once; each match adds
+its keyword's weight, and the total decides the focus. Keyword syntax:
+
+    "tiempo verbal"   multi-word phrase (any run of whitespace between words)
+    "corrig*"         word prefix: corrige, corrígeme, corrigiendo...
+    "ser": 0.5        weak signal; needs another match to reach the threshold
+"""
+import re
+import unicodedata
+from typing import Mapping, List, Tuple
+
+GRAMMAR = "GRAMMAR_OR_IMPROVEMENT"
+GENERAL = "GENERAL"
+
+
+_MARKS = re.compile(r"[\u0300-\u036f]")
+
+
+def fold(text: str) -> str:
+    """'¿Qué es el PRETÉRITO?' -> '¿que es el preterito?'"""
+    if text.isascii():
+        return text.lower()
+    return _MARKS.sub("", unicodedata.normalize("NFD", text.casefold()))
+
+
+def _trie_regex(keywords: List[str]) -> str:
+    """
+    Regex for a set of folded keywords, factored as a trie. A space stands for
+    any run of whitespace and a trailing "*" for the rest of the word.
+    """
+    trie: dict = {}
+    for kw in keywords:
+        node = trie
+        for ch in kw:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def render(node: dict) -> str:
+        ends = "" in node
+        branches = []
+        for ch in sorted(k for k in node if k):
+            if ch == "*":
+                atom = r"\w*"
+            elif ch == " ":
+                atom = r"\s+"
+            else:
+                atom = re.escape(ch)
+            branches.append(atom + render(node[ch]))
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if ends:
+            # Greedy optional keeps the longest phrase; \b backtracks to a shorter one
+            body = "(?:" + body + ")?"
+        return body
+
+    return render(trie)
+
+
+class FocusDetector:
+    def __init__(self, keywords: Mapping[str, float], threshold: float = 1.0):
+        self.threshold = threshold
+        self.exact = {}
+        self.prefixes: List[Tuple[str, float]] = []
+        folded = []
+        for kw, weight in keywords.items():
+            kw = " ".join(fold(kw).split())
+            folded.append(kw)
+            if kw.endswith("*"):
+                self.prefixes.append((kw[:-1], weight))
+            else:
+                self.exact[kw] = weight
+        self.pattern = re.compile(r"\b" + _trie_regex(folded) + r"\b")
+        self.prefixes.sort(key=lambda p: len(p[0]), reverse=True)
+
+    def _weight(self, match: str) -> float:
+        match = " ".join(match.split())
+        if match in self.exact:
+            return self.exact[match]
+        for prefix, weight in self.prefixes:
+            if match.startswith(prefix):
+                return weight
+        return 0.0
+
+    def matches(self, text: str) -> List[str]:
+        return [m.group(0) for m in self.pattern.finditer(fold(text))]
+
+    def score(self, text: str) -> float:
+        return sum(self._weight(m.group(0)) for m in self.pattern.finditer(fold(text)))
+
+    def detect(self, text: str) -> str:
+        total = 0.0
+        for m in self.pattern.finditer(fold(text)):
+            total += self._weight(m.group(0))
+            if total >= self.threshold:
+                return GRAMMAR
+        return GENERAL
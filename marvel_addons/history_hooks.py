@@ -1,8 +1,31 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
 from flask import session
-from .models import db_session, User, Course, Message
+from .metrics import registry
+
+# SQLAlchemy and the models are imported on first use (the writer thread's
+# first batch), so importing this module from app.py stays cheap
+
+log = logging.getLogger(__name__)
+
+HISTORY_TURNS = registry.counter(
+    "marvel_history_turns_total", "Chat turns handed to the history writer, by outcome (written, dropped, failed)",
+    ["outcome"])
+HISTORY_BATCH_SECONDS = registry.histogram(
+    "marvel_history_batch_seconds", "Time to write one batch of turns (and rollups) to the database")
+HISTORY_QUEUE_WAIT_SECONDS = registry.histogram(
+    "marvel_history_queue_wait_seconds", "Time from /chat enqueueing a turn until its batch is committed")
 
 def current_user_and_course():
-    lms_user_id = session.get("lti_user_id", "anon")
+    """Only for LTI sessions: there is no shared user for visitors without a launch."""
+    from .models import db_session, User, Course
+    lms_user_id = session["lti_user_id"]
     lms_course_id = session.get("lti_course_id", "general")
     name = session.get("lti_user_name", "Student")
     role = session.get("lti_user_role", "Learner")
@@ -20,9 +43,193 @@ def current_user_and_course():
     return user, course, db
 
 def save_interaction(sess, user_text, assistant_text):
+    from .models import Message
+    if not sess.get("lti_user_id"):
+        return
     user, course, db = current_user_and_course()
     db.add_all([
         Message(user_id=user.id, course_id=course.id, role="user", content=user_text),
         Message(user_id=user.id, course_id=course.id, role="assistant", content=assistant_text),
     ])
     db.commit()
+
+
+# ==================== WRITE-BEHIND PERSISTENCE ====================
+
+
+def turn_identity(sess):
+    """
+    LTI identity of the current request (works on any dict-like session), or
+    None without an LTI launch: those turns are not persisted at all.
+    """
+    if not sess.get("lti_user_id"):
+        return None
+    return (
+        sess["lti_user_id"],
+        sess.get("lti_user_name", "Student"),
+        sess.get("lti_user_role", "Learner"),
+        sess.get("lti_course_id", "general"),
+    )
+
+
+class HistoryWriter:
+    """
+    /chat hands each (user, assistant) pair to enqueue(), which never blocks;
+    a background thread bulk-inserts them as Message rows in batches and
+    updates the DailyActivity rollups in the same transaction. User and course
+    primary keys are cached per process, so a batch costs one INSERT plus
+    lookups only for people not seen before. When the queue is full the
+    turn is dropped and counted in `dropped`.
+    """
+
+    def __init__(self, max_queue=5000, batch_size=200, flush_interval=1.0):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = {"enqueued": 0, "written": 0, "dropped": 0, "batches": 0, "errors": 0}
+        self._user_ids = {}
+        self._course_ids = {}
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Started lazily so each forked gunicorn worker gets its own thread
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._user_ids.clear()
+            self._course_ids.clear()
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.close)
+
+    def enqueue(self, identity, user_text, assistant_text, level=None, focus=None):
+        self._ensure_started()
+        now = datetime.utcnow()
+        try:
+            self._queue.put_nowait((identity, user_text, assistant_text, now, level, focus))
+        except queue.Full:
+            self.stats["dropped"] += 1
+            HISTORY_TURNS.inc(outcome="dropped")
+            if self.stats["dropped"] % 100 == 1:
+                log.warning("history queue full; %d turns dropped so far", self.stats["dropped"])
+            return False
+        self.stats["enqueued"] += 1
+        return True
+
+    def close(self, timeout=10.0):
+        """Flushes what is queued and stops the thread (registered with atexit)."""
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._pid = None  # a later enqueue starts a fresh thread
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            stop = item is None
+            batch = [] if stop else [item]
+            # Gather whatever else arrives within flush_interval of the first
+            # item, up to batch_size, so steady traffic still flushes every interval
+            deadline = time.monotonic() + self.flush_interval
+            while not stop and len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                else:
+                    batch.append(item)
+            if batch:
+                self._write(batch)
+            if stop:
+                return
+
+    def _write(self, batch):
+        from sqlalchemy import insert
+        from .models import db_session, Message
+        from .analytics import add_turns
+        db = db_session()
+        started = time.perf_counter()
+        try:
+            users = {b[0][0]: b[0] for b in batch}
+            courses = {b[0][3] for b in batch}
+            user_ids = self._resolve_users(db, users)
+            course_ids = self._resolve_courses(db, courses)
+            rows, turns = [], []
+            for (uid, _, _, cid), user_text, assistant_text, ts, level, focus in batch:
+                user_pk, course_pk = user_ids[uid], course_ids[cid]
+                common = dict(user_id=user_pk, course_id=course_pk, ts=ts, level=level, focus=focus)
+                rows.append(dict(common, role="user", content=user_text))
+                rows.append(dict(common, role="assistant", content=assistant_text))
+                turns.append((course_pk, user_pk, ts.date(), level, focus))
+            db.execute(insert(Message), rows)
+            add_turns(db, turns)
+            db.commit()
+            # Only now are new users' and courses' keys real; a rollback discards them
+            self._user_ids.update(user_ids)
+            self._course_ids.update(course_ids)
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+            HISTORY_TURNS.inc(len(batch), outcome="written")
+            committed = datetime.utcnow()
+            for item in batch:
+                HISTORY_QUEUE_WAIT_SECONDS.observe((committed - item[3]).total_seconds())
+        except Exception:
+            db.rollback()
+            self.stats["errors"] += 1
+            HISTORY_TURNS.inc(len(batch), outcome="failed")
+            log.exception("could not persist %d chat turns", len(batch))
+        finally:
+            HISTORY_BATCH_SECONDS.observe(time.perf_counter() - started)
+            db.remove()
+
+    def _resolve_users(self, db, users):
+        """Primary keys of `users`, from the cache or the database; new users are added (uncommitted)."""
+        from sqlalchemy import select
+        from .models import User
+        ids = {uid: self._user_ids[uid] for uid in users if uid in self._user_ids}
+        missing = [uid for uid in users if uid not in ids]
+        if not missing:
+            return ids
+        found = dict(db.execute(
+            select(User.lms_user_id, User.id).where(User.lms_user_id.in_(missing))).all())
+        for uid in missing:
+            if uid not in found:
+                _, name, role, _ = users[uid]
+                user = User(lms_user_id=uid, name=name, role=role)
+                db.add(user)
+                db.flush()
+                found[uid] = user.id
+        ids.update(found)
+        return ids
+
+    def _resolve_courses(self, db, courses):
+        """Like _resolve_users, for course ids."""
+        from sqlalchemy import select
+        from .models import Course
+        ids = {cid: self._course_ids[cid] for cid in courses if cid in self._course_ids}
+        missing = [cid for cid in courses if cid not in ids]
+        if not missing:
+            return ids
+        found = dict(db.execute(
+            select(Course.lms_course_id, Course.id).where(Course.lms_course_id.in_(missing))).all())
+        for cid in missing:
+            if cid not in found:
+                course = Course(lms_course_id=cid, title="Course")
+                db.add(course)
+                db.flush()
+                found[cid] = course.id
+        ids.update(found)
+        return ids
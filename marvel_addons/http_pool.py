@@ -0,0 +1,202 @@
+"""
+HTTP transport for the OpenAI clients: a sized connection pool, keep-alive,
+optional HTTP/2, explicit timeouts, warm-up and pool statistics.
+
+The SDK's default client knows nothing about how many calls a worker makes
+at once, and a freshly forked worker opens every connection (TCP + TLS) on
+its first students' requests, which shows up in p99 after each deploy or
+worker recycle. Here:
+
+- the pool holds up to `max_connections` (match the worker's concurrency:
+  gunicorn --threads, or UPSTREAM_CONCURRENCY for asgi.py), keeps them alive
+  for `keepalive_expiry` seconds, and waits at most `pool_timeout` for a free
+  one;
+- timeouts are explicit: `connect` for TCP + TLS, `read` per read (also the
+  per-attempt timeout in upstream.py), and the whole call is bounded by
+  UPSTREAM_DEADLINE there;
+- warm()/awarm() open `warm` connections ahead of traffic (gunicorn.conf.py
+  calls it on post_fork, asgi.py on lifespan startup);
+- pool_stats() reports open, active, idle and waiting connections per client
+  (GET /upstream/stats), and every new connection is counted and timed in
+  /metrics, so cold connections are visible.
+
+HTTP/2 needs the `h2` package (pip install "httpx[http2]"); without it the
+pool stays on HTTP/1.1.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Union
+
+import httpx
+import openai
+
+from .metrics import registry
+
+try:
+    import h2  # noqa: F401
+except ImportError:
+    h2 = None
+
+log = logging.getLogger(__name__)
+
+CONNECTIONS_OPENED = registry.counter(
+    "marvel_upstream_connections_total", "New connections to the model API (each pays TCP + TLS)",
+    ["client"])
+CONNECT_SECONDS = registry.histogram(
+    "marvel_upstream_connect_seconds", "TCP connect and TLS handshake time of new model API connections",
+    ["client"])
+
+# name -> httpx client, for pool_stats()
+clients: Dict[str, Union[httpx.Client, httpx.AsyncClient]] = {}
+
+
+@dataclass
+class PoolSettings:
+    max_connections: int = 16
+    max_keepalive: int = 16
+    keepalive_expiry: float = 60.0
+    http2: bool = False
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+    pool_timeout: float = 10.0
+    warm: int = 2
+
+    @classmethod
+    def from_env(cls, max_connections: int) -> "PoolSettings":
+        size = int(os.getenv("UPSTREAM_POOL_SIZE") or max_connections)
+        return cls(
+            max_connections=size,
+            max_keepalive=int(os.getenv("UPSTREAM_POOL_KEEPALIVE") or size),
+            keepalive_expiry=float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "60")),
+            http2=os.getenv("UPSTREAM_HTTP2", "0").lower() in ("1", "true", "yes"),
+            connect_timeout=float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5")),
+            read_timeout=float(os.getenv("UPSTREAM_ATTEMPT_TIMEOUT", "30")),
+            pool_timeout=float(os.getenv("UPSTREAM_POOL_TIMEOUT", "10")),
+            warm=int(os.getenv("UPSTREAM_POOL_WARM", "2")),
+        )
+
+    @property
+    def use_http2(self) -> bool:
+        if self.http2 and h2 is None:
+            log.warning("UPSTREAM_HTTP2 is set but h2 is not installed; using HTTP/1.1")
+        return self.http2 and h2 is not None
+
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.max_connections,
+                            max_keepalive_connections=min(self.max_keepalive, self.max_connections),
+                            keepalive_expiry=self.keepalive_expiry)
+
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(self.read_timeout, connect=self.connect_timeout, pool=self.pool_timeout)
+
+
+# --- connection tracing (httpcore's "trace" request extension) ---
+
+class _ConnectTrace:
+    """Times and counts the new connection a request opens, if it opens one."""
+
+    def __init__(self, name: str, tls: bool):
+        self.name = name
+        self.ready = "connection.start_tls.complete" if tls else "connection.connect_tcp.complete"
+        self.started = None
+
+    def __call__(self, event: str, info) -> None:
+        if event == "connection.connect_tcp.started":
+            self.started = time.perf_counter()
+        elif self.started is not None and (event == self.ready or event.endswith(".failed")):
+            CONNECT_SECONDS.observe(time.perf_counter() - self.started, client=self.name)
+            if event == self.ready:
+                CONNECTIONS_OPENED.inc(client=self.name)
+            self.started = None
+
+
+def _on_request(name: str):
+    def hook(request: httpx.Request) -> None:
+        request.extensions["trace"] = _ConnectTrace(name, request.url.scheme == "https")
+    return hook
+
+
+def _on_arequest(name: str):
+    async def hook(request: httpx.Request) -> None:
+        trace = _ConnectTrace(name, request.url.scheme == "https")
+
+        async def atrace(event: str, info) -> None:
+            trace(event, info)
+
+        request.extensions["trace"] = atrace
+    return hook
+
+
+# --- clients ---
+
+def http_client(settings: PoolSettings, name: str = "sync") -> httpx.Client:
+    transport = httpx.HTTPTransport(limits=settings.limits(), http2=settings.use_http2)
+    client = httpx.Client(transport=transport, timeout=settings.timeout(),
+                          event_hooks={"request": [_on_request(name)]})
+    clients[name] = client
+    return client
+
+
+def async_http_client(settings: PoolSettings, name: str = "async") -> httpx.AsyncClient:
+    transport = httpx.AsyncHTTPTransport(limits=settings.limits(), http2=settings.use_http2)
+    client = httpx.AsyncClient(transport=transport, timeout=settings.timeout(),
+                               event_hooks={"request": [_on_arequest(name)]})
+    clients[name] = client
+    return client
+
+
+# --- warm-up ---
+
+def _ping(client: openai.OpenAI, timeout: float) -> None:
+    try:
+        # Any authenticated GET opens (and keeps alive) a connection; the answer does not matter
+        client.with_options(timeout=timeout, max_retries=0).models.list()
+    except openai.APIError:
+        pass
+
+
+def warm(client: openai.OpenAI, connections: int, timeout: float = 10.0) -> None:
+    """Opens up to `connections` keep-alive connections in parallel; blocks until done."""
+    threads = [threading.Thread(target=_ping, args=(client, timeout), daemon=True)
+               for _ in range(max(0, connections))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout + 1)
+
+
+async def awarm(client: openai.AsyncOpenAI, connections: int, timeout: float = 10.0) -> None:
+    async def ping():
+        try:
+            await client.with_options(timeout=timeout, max_retries=0).models.list()
+        except openai.APIError:
+            pass
+
+    await asyncio.gather(*[ping() for _ in range(max(0, connections))])
+
+
+# --- statistics ---
+
+def _pool_stats(client) -> Dict[str, int]:
+    pool = getattr(client._transport, "_pool", None)  # httpcore's ConnectionPool
+    if pool is None:
+        return {}
+    connections: List = list(pool.connections)
+    idle = sum(1 for c in connections if c.is_idle())
+    return {
+        "connections": len(connections),
+        "active": len(connections) - idle,
+        "idle": idle,
+        "waiting": sum(1 for r in list(getattr(pool, "_requests", ())) if r.is_queued()),
+        "max_connections": pool._max_connections,
+        "http2": bool(getattr(pool, "_http2", False)),
+    }
+
+
+def pool_stats() -> Dict[str, Dict[str, int]]:
+    """Connection pool state of this process's clients, by client name."""
+    return {name: _pool_stats(client) for name, client in clients.items()}
@@ -1,39 +1,49 @@
-from flask import Blueprint, request, session, render_template, jsonify
-from pylti1p3.tool_config import ToolConfJsonFile
-from pylti1p3.flask import FlaskOIDCLogin, FlaskMessageLaunch, FlaskRequest
+import base64
+import binascii
+import sys
+import threading
+from datetime import datetime
+from flask import Blueprint, Response, request, session, render_template, jsonify
 try:
     import settings
 except ImportError:
     import settings_sample as settings
 
+# PyLTI1p3 and SQLAlchemy are imported by the views that need them, so
+# registering the blueprint costs nothing at boot
+
 lti_bp = Blueprint("lti", __name__, template_folder="templates")
 
-def _get_tool_conf():
-    conf = {
-        "iss": {
-            settings.PLATFORM_ISSUER: {
-                "client_id": settings.CLIENT_ID,
-                "auth_login_url": settings.OIDC_AUTH_ENDPOINT,
-                "auth_token_url": settings.OIDC_TOKEN_ENDPOINT,
-                "key_set_url": settings.PLATFORM_JWKS_URL,
-                "aud": settings.CLIENT_ID,
-                "deployment_ids": [settings.DEPLOYMENT_ID]
-            }
-        }
-    }
-    return ToolConfJsonFile(conf)
+_lti_keys = None
+_lti_keys_lock = threading.Lock()
+
+def lti_keys():
+    """Tool config, tool JWKS and the platform key cache, built once per process on first use."""
+    global _lti_keys
+    if _lti_keys is None:
+        with _lti_keys_lock:
+            if _lti_keys is None:
+                from .lti_keys import LtiKeys
+                _lti_keys = LtiKeys(settings)
+    return _lti_keys
+
+@lti_bp.teardown_app_request
+def remove_db_session(_=None):
+    # Only requests that touched the database have imported the models
+    models = sys.modules.get(__package__ + ".models")
+    if models is not None:
+        models.SessionLocal.remove()
 
 @lti_bp.route("/login", methods=["GET"])
 def login():
-    tool_conf = _get_tool_conf()
-    oidc_login = FlaskOIDCLogin(FlaskRequest(), tool_conf)
+    from pylti1p3.contrib.flask import FlaskOIDCLogin, FlaskRequest
+    oidc_login = FlaskOIDCLogin(FlaskRequest(), lti_keys().tool_conf)
     return oidc_login.redirect(settings.TOOL_REDIRECT_URI, request.args)
 
 @lti_bp.route("/launch", methods=["POST"])
 def launch():
-    tool_conf = _get_tool_conf()
-    req = FlaskRequest()
-    launch = FlaskMessageLaunch(req, tool_conf).validate_registration()
+    from pylti1p3.contrib.flask import FlaskRequest
+    launch = lti_keys().message_launch(FlaskRequest()).validate_registration()
     launch_data = launch.get_launch_data()
     session["lti_user_id"] = launch_data.get("sub")
     session["lti_user_name"] = launch_data.get("name") or "Student"
@@ -44,28 +54,156 @@ def launch():
 
 @lti_bp.route("/jwks", methods=["GET"])
 def jwks():
-    return jsonify({"keys": []})
+    resp = jsonify(lti_keys().tool_jwks)
+    resp.headers["Cache-Control"] = "public, max-age=3600"
+    return resp
+
+# --- History pages: newest first, keyset-paginated ---
+# ?limit=N (max 200) and ?before=<cursor>, where the cursor comes from the
+# X-Next-Cursor header of the previous page (absent on the last page). Each
+# page is one range scan on the (course_id|user_id, ts, id) indexes, however
+# large the table grows.
+
+MAX_PAGE = 200
+
+def _encode_cursor(msg):
+    raw = f"{msg.ts.isoformat()}|{msg.id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    ts, msg_id = raw.rsplit("|", 1)
+    return datetime.fromisoformat(ts), int(msg_id)
+
+def _page(query, default_limit):
+    from sqlalchemy import and_, or_
+    from .models import Message
+    try:
+        limit = max(1, min(int(request.args.get("limit", default_limit)), MAX_PAGE))
+        before = request.args.get("before")
+        if before:
+            ts, msg_id = _decode_cursor(before)
+            query = query.filter(or_(Message.ts < ts, and_(Message.ts == ts, Message.id < msg_id)))
+    except (ValueError, binascii.Error):
+        return jsonify({"error": "Invalid limit or cursor"}), 400
+
+    msgs = query.order_by(Message.ts.desc(), Message.id.desc()).limit(limit + 1).all()
+    resp = jsonify([{"role": m.role, "content": m.content, "ts": m.ts.isoformat()} for m in msgs[:limit]])
+    if len(msgs) > limit:
+        resp.headers["X-Next-Cursor"] = _encode_cursor(msgs[limit - 1])
+    return resp
 
 @lti_bp.route("/history/me", methods=["GET"])
 def my_history():
+    uid = session.get("lti_user_id")
+    if not uid:
+        return jsonify({"error": "LTI launch required"}), 403
     from .models import db_session, User, Message
-    uid = session.get("lti_user_id", "anon")
     db = db_session()
     user = db.query(User).filter_by(lms_user_id=uid).first()
     if not user:
         return jsonify([])
-    msgs = db.query(Message).filter_by(user_id=user.id).order_by(Message.ts.desc()).limit(50).all()
-    return jsonify([{"role": m.role, "content": m.content, "ts": m.ts.isoformat()} for m in msgs])
+    return _page(db.query(Message).filter_by(user_id=user.id), 50)
 
 @lti_bp.route("/history/course", methods=["GET"])
 def course_history():
+    """Instructor view of the course; ?student=<lms_user_id> narrows it to one student."""
     if session.get("lti_user_role") != "Instructor":
         return jsonify({"error": "Instructor only"}), 403
-    from .models import db_session, Course, Message
+    from .models import db_session, Course, User, Message
     cid = session.get("lti_course_id", "course")
     db = db_session()
     course = db.query(Course).filter_by(lms_course_id=cid).first()
     if not course:
         return jsonify([])
-    msgs = db.query(Message).filter_by(course_id=course.id).order_by(Message.ts.desc()).limit(100).all()
-    return jsonify([{"role": m.role, "content": m.content, "ts": m.ts.isoformat()} for m in msgs])
+    query = db.query(Message).filter_by(course_id=course.id)
+    student = request.args.get("student")
+    if student:
+        user = db.query(User).filter_by(lms_user_id=student).first()
+        if not user:
+            return jsonify([])
+        query = query.filter_by(user_id=user.id)
+    return _page(query, 100)
+
+@lti_bp.route("/analytics/course", methods=["GET"])
+def course_analytics():
+    """Activity, focus mix, levels and turns per day for the course (?days=30), from the rollups only."""
+    if session.get("lti_user_role") != "Instructor":
+        return jsonify({"error": "Instructor only"}), 403
+    from .models import db_session, Course
+    from .analytics import course_summary
+    try:
+        days = max(1, min(int(request.args.get("days", 30)), 366))
+    except ValueError:
+        return jsonify({"error": "Invalid days"}), 400
+    cid = session.get("lti_course_id", "course")
+    db = db_session()
+    course = db.query(Course).filter_by(lms_course_id=cid).first()
+    if not course:
+        return jsonify({})
+    return jsonify(course_summary(db, course.id, days))
+
+@lti_bp.route("/search/course", methods=["GET"])
+def course_search():
+    """Accent-insensitive search in the course: ?q=subjuntivo&page=1&limit=20[&student=<lms_user_id>]."""
+    if session.get("lti_user_role") != "Instructor":
+        return jsonify({"error": "Instructor only"}), 403
+    from .models import db_session, Course, User
+    from .search import search
+    q = request.args.get("q", "").strip()
+    try:
+        limit = max(1, min(int(request.args.get("limit", 20)), MAX_PAGE))
+        page = max(1, int(request.args.get("page", 1)))
+    except ValueError:
+        return jsonify({"error": "Invalid page or limit"}), 400
+    cid = session.get("lti_course_id", "course")
+    db = db_session()
+    course = db.query(Course).filter_by(lms_course_id=cid).first()
+    if not q or not course:
+        return jsonify({"q": q, "page": page, "results": []})
+    user_pk = None
+    student = request.args.get("student")
+    if student:
+        user = db.query(User).filter_by(lms_user_id=student).first()
+        if not user:
+            return jsonify({"q": q, "page": page, "results": []})
+        user_pk = user.id
+    results = search(db, course.id, q, limit=limit, offset=(page - 1) * limit, user_pk=user_pk)
+    return jsonify({"q": q, "page": page, "results": results})
+
+@lti_bp.route("/export/course", methods=["GET"])
+def course_export():
+    """Streams the course's transcripts: ?format=csv|jsonl&since=&until=&student=&gzip=1."""
+    if session.get("lti_user_role") != "Instructor":
+        return jsonify({"error": "Instructor only"}), 403
+    from .models import db_session, Course, User
+    from . import export
+    fmt = request.args.get("format", "csv")
+    if fmt not in export.FORMATS:
+        return jsonify({"error": "format must be csv or jsonl"}), 400
+    try:
+        since = export.parse_day(request.args.get("since"))
+        until = export.parse_day(request.args.get("until"), end=True)
+    except ValueError:
+        return jsonify({"error": "Invalid since or until (use YYYY-MM-DD)"}), 400
+    compress = request.args.get("gzip") in ("1", "true", "yes")
+    cid = session.get("lti_course_id", "course")
+    db = db_session()
+    course = db.query(Course).filter_by(lms_course_id=cid).first()
+    if not course:
+        return jsonify({"error": "Unknown course"}), 404
+    user_pk = None
+    student = request.args.get("student")
+    if student:
+        user = db.query(User).filter_by(lms_user_id=student).first()
+        if not user:
+            return jsonify({"error": "Unknown student"}), 404
+        user_pk = user.id
+    # The generator uses its own connection, so the request's session is released now
+    course_pk = course.id
+    db.remove()
+    resp = Response(export.stream(course_pk, fmt, since, until, user_pk, compress),
+                    mimetype="application/gzip" if compress else export.FORMATS[fmt])
+    resp.headers["Content-Disposition"] = f'attachment; filename="{export.filename(cid, fmt, compress)}"'
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
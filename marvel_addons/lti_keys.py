@@ -0,0 +1,154 @@
+"""
+LTI configuration and keys, built once per process.
+
+- tool_conf: the pylti1p3 ToolConfDict for the platform, with the tool's
+  private/public key pair attached (previously rebuilt on every request).
+- tool_jwks: the public JWKS served at /lti/jwks, derived once from
+  TOOL_PRIVATE_KEY_PEM.
+- PlatformJWKS: the platform's key set, fetched over a keep-alive session and
+  cached for `ttl` seconds. A launch signed with a kid we have not seen
+  (the platform rotated its keys) triggers an immediate refetch; such
+  refetches happen at most once every `min_refresh` seconds, so unknown kids
+  cannot be used to hammer the platform. If a refetch fails, the cached keys
+  keep being used.
+
+CachedMessageLaunch plugs the cache into pylti1p3's launch validation, so a
+launch only goes to the platform when the cache is cold, expired or missing
+the kid.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import requests
+from cryptography.hazmat.primitives import serialization
+from pylti1p3.contrib.flask import FlaskMessageLaunch
+from pylti1p3.exception import LtiException
+from pylti1p3.registration import Registration
+from pylti1p3.tool_config import ToolConfDict
+
+log = logging.getLogger(__name__)
+
+JWKS_TTL = int(os.getenv("LTI_JWKS_TTL", "3600"))
+JWKS_MIN_REFRESH = int(os.getenv("LTI_JWKS_MIN_REFRESH", "30"))
+JWKS_TIMEOUT = float(os.getenv("LTI_JWKS_TIMEOUT", "5"))
+
+
+def public_key_pem(private_key_pem: str) -> Optional[str]:
+    """PEM of the public half of the tool key, or None while the key is still a placeholder."""
+    try:
+        key = serialization.load_pem_private_key(private_key_pem.encode("utf-8"), password=None)
+    except (ValueError, TypeError):
+        log.warning("TOOL_PRIVATE_KEY_PEM is not a valid private key; /lti/jwks will be empty")
+        return None
+    return key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode("utf-8")
+
+
+class PlatformJWKS:
+    def __init__(self, url: str, ttl: float = JWKS_TTL, min_refresh: float = JWKS_MIN_REFRESH,
+                 timeout: float = JWKS_TIMEOUT, session: Optional[requests.Session] = None):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.keys: Optional[Dict[str, Any]] = None
+        self.fetched_at = 0.0
+        self.kid_refreshed_at = float("-inf")
+        self.stats = {"hits": 0, "fetches": 0, "errors": 0}
+        self._lock = threading.Lock()
+
+    def _has_kid(self, kid: Optional[str]) -> bool:
+        return kid is None or any(k.get("kid") == kid for k in self.keys.get("keys", []))
+
+    def _fresh(self, kid: Optional[str]) -> bool:
+        return (self.keys is not None
+                and time.monotonic() - self.fetched_at < self.ttl
+                and self._has_kid(kid))
+
+    def get(self, kid: Optional[str] = None) -> Dict[str, Any]:
+        """The platform key set, refetched when expired or when it lacks `kid`."""
+        if self._fresh(kid):
+            self.stats["hits"] += 1
+            return self.keys
+        with self._lock:
+            # Another thread may have refreshed while we waited
+            if self._fresh(kid):
+                self.stats["hits"] += 1
+                return self.keys
+            now = time.monotonic()
+            if self.keys is None or now - self.fetched_at >= self.ttl:
+                self._fetch()
+            elif now - self.kid_refreshed_at >= self.min_refresh:
+                self.kid_refreshed_at = now
+                self._fetch()
+            if self.keys is None:
+                raise LtiException(f"Could not fetch platform keys from {self.url}")
+            return self.keys
+
+    def _fetch(self) -> None:
+        self.stats["fetches"] += 1
+        try:
+            resp = self.session.get(self.url, timeout=self.timeout)
+            resp.raise_for_status()
+            keys = resp.json()
+            if not isinstance(keys.get("keys"), list):
+                raise ValueError("no 'keys' list")
+        except (requests.RequestException, ValueError, AttributeError) as e:
+            self.stats["errors"] += 1
+            log.warning("platform JWKS fetch from %s failed: %r", self.url, e)
+            if self.keys is not None:
+                self.fetched_at = time.monotonic() - self.ttl + self.min_refresh  # retry soon
+            return
+        self.keys = keys
+        self.fetched_at = time.monotonic()
+
+
+class LtiKeys:
+    """Tool config, tool JWKS and platform key caches for one settings module."""
+
+    def __init__(self, settings):
+        conf = {
+            settings.PLATFORM_ISSUER: {
+                "client_id": settings.CLIENT_ID,
+                "auth_login_url": settings.OIDC_AUTH_ENDPOINT,
+                "auth_token_url": settings.OIDC_TOKEN_ENDPOINT,
+                "key_set_url": settings.PLATFORM_JWKS_URL,
+                "auth_audience": None,
+                "deployment_ids": [settings.DEPLOYMENT_ID],
+            }
+        }
+        self.tool_conf = ToolConfDict(conf)
+        public_pem = public_key_pem(settings.TOOL_PRIVATE_KEY_PEM)
+        if public_pem:
+            self.tool_conf.set_private_key(settings.PLATFORM_ISSUER, settings.TOOL_PRIVATE_KEY_PEM)
+            self.tool_conf.set_public_key(settings.PLATFORM_ISSUER, public_pem)
+        self.tool_jwks = {"keys": [Registration.get_jwk(public_pem)] if public_pem else []}
+        # One keep-alive session for all platform calls
+        self.session = requests.Session()
+        self.platforms: Dict[str, PlatformJWKS] = {}
+        self._lock = threading.Lock()
+
+    def platform(self, url: str) -> PlatformJWKS:
+        jwks = self.platforms.get(url)
+        if jwks is None:
+            with self._lock:
+                jwks = self.platforms.setdefault(url, PlatformJWKS(url, session=self.session))
+        return jwks
+
+    def message_launch(self, request) -> "CachedMessageLaunch":
+        return CachedMessageLaunch(request, self.tool_conf, requests_session=self.session, keys=self)
+
+
+class CachedMessageLaunch(FlaskMessageLaunch):
+    def __init__(self, request, tool_config, keys: LtiKeys, **kwargs):
+        super().__init__(request, tool_config, **kwargs)
+        self._keys = keys
+
+    def fetch_public_key(self, key_set_url):
+        kid = self._jwt.get("header", {}).get("kid")
+        return self._keys.platform(key_set_url).get(kid)
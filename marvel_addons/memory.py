@@ -0,0 +1,151 @@
+"""
+Rolling conversation memory: a running summary plus the latest turns.
+
+Without it /chat sends the last 8 raw messages, so prompts grow until that
+cutoff and everything older is forgotten. With it each request sends
+
+    the summary of everything older        (at most `summary_tokens`)
+  + the newest messages that fit `budget`  (tokens)
+
+so the prompt size is set by configuration, not by how long the
+conversation is. Tokens are counted locally (prompts.count_tokens).
+
+Once the unsummarized history passes `budget`, the conversation is folded on
+a background thread: the model rewrites the summary with the oldest messages
+added (the student's level, recurring grammar issues with a short example,
+stated goals, topics and pending micro-goals), keeping about half the budget
+as raw recent turns. ConversationStore.fold() only writes if nobody moved the
+front of the history meanwhile, so a slow or duplicated fold never loses or
+repeats turns. The request path only pays for schedule(), a non-blocking
+enqueue.
+"""
+import logging
+import os
+import queue
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from .conversations import Conversation, ConversationStore
+from .metrics import registry
+from .prompts import count_tokens, truncate_tokens
+from .upstream import UNAVAILABLE_REPLY, EMPTY_REPLY
+
+log = logging.getLogger(__name__)
+
+SUMMARIES = registry.counter(
+    "marvel_summaries_total", "Conversation summary updates, by outcome (folded, stale, failed, dropped)",
+    ["outcome"])
+SUMMARY_SECONDS = registry.histogram(
+    "marvel_summary_seconds", "Model time to update one conversation summary")
+
+SUMMARY_PROMPT = """
+Eres el cuaderno de notas de Marvel, una tutora de español. Actualiza las
+notas sobre el estudiante con los turnos nuevos. Conserva solo lo útil para
+seguir la tutoría:
+- Nivel: el nivel elegido y cómo escribe de verdad.
+- Errores recurrentes: puntos gramaticales que falla, con un ejemplo breve suyo.
+- Metas: lo que el estudiante dijo que quiere lograr.
+- Temas: de qué han hablado y qué micro-metas quedaron pendientes.
+Escribe en español, en viñetas breves, máximo {words} palabras en total.
+No saludes ni expliques nada más.
+"""
+
+_SPEAKERS = {"user": "Estudiante", "assistant": "Marvel"}
+
+
+def recent(history: List[Dict[str, str]], budget: int) -> List[Dict[str, str]]:
+    """The newest messages of `history` whose tokens add up to at most `budget`."""
+    used, start = 0, len(history)
+    for i in range(len(history) - 1, -1, -1):
+        used += count_tokens(history[i]["content"])
+        if used > budget:
+            break
+        start = i
+    return history[start:]
+
+
+def summary_messages(summary: str, fold: List[Dict[str, str]], level: str, words: int):
+    turns = "\n".join(f"{_SPEAKERS.get(m['role'], 'Estudiante')}: {m['content']}" for m in fold)
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT.format(words=words)},
+        {"role": "user", "content": (
+            f"Nivel elegido: {level}\n\n"
+            f"Notas actuales:\n{summary or '(ninguna todavía)'}\n\n"
+            f"Turnos nuevos:\n{turns}"
+        )},
+    ]
+
+
+class Summarizer:
+    def __init__(self, store: ConversationStore, call: Callable[[List[Dict[str, str]]], str],
+                 budget: int = 1200, summary_tokens: int = 250, max_queue: int = 1000):
+        self.store = store
+        self.call = call
+        self.budget = budget
+        self.summary_tokens = summary_tokens
+        self.max_queue = max_queue
+        self._queue = None
+        self._pending = set()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def context(self, conversation: Conversation) -> Tuple[str, List[Dict[str, str]]]:
+        """(summary, recent messages) to send with the next request."""
+        return conversation.summary, recent(conversation.history, self.budget)
+
+    def schedule(self, cid: str, level: str) -> None:
+        """Queues `cid` for a summary check; never blocks, one pending entry per conversation."""
+        self._ensure_started()
+        with self._lock:
+            if cid in self._pending:
+                return
+            self._pending.add(cid)
+        try:
+            self._queue.put_nowait((cid, level))
+        except queue.Full:
+            with self._lock:
+                self._pending.discard(cid)
+            SUMMARIES.inc(outcome="dropped")  # retried on the conversation's next turn
+
+    def _ensure_started(self):
+        # Started lazily so each forked gunicorn worker gets its own thread
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._pending = set()
+            threading.Thread(target=self._run, name="summarizer", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            cid, level = self._queue.get()
+            with self._lock:
+                self._pending.discard(cid)
+            try:
+                self.summarize(cid, level)
+            except Exception:
+                log.exception("could not summarize conversation %s", cid)
+
+    def summarize(self, cid: str, level: str) -> bool:
+        """Folds the oldest messages of `cid` into its summary if it is over budget."""
+        conversation = self.store.get(cid)
+        history = conversation.history
+        if sum(count_tokens(m["content"]) for m in history) <= self.budget:
+            return False
+        fold = history[:len(history) - len(recent(history, self.budget // 2))]
+        if not fold:
+            return False
+        # ~1.5 tokens per Spanish word; the token cap below is the hard limit
+        words = self.summary_tokens * 2 // 3
+        with SUMMARY_SECONDS.time():
+            reply = self.call(summary_messages(conversation.summary, fold, level, words))
+        if not reply or reply in (UNAVAILABLE_REPLY, EMPTY_REPLY):
+            SUMMARIES.inc(outcome="failed")  # history stays; the next turn tries again
+            return False
+        summary = truncate_tokens(reply.strip(), self.summary_tokens)
+        folded = self.store.fold(cid, conversation.folded, len(fold), summary)
+        SUMMARIES.inc(outcome="folded" if folded else "stale")
+        return folded
@@ -0,0 +1,296 @@
+"""
+Prometheus-format metrics shared by every gunicorn worker.
+
+Counters and histograms are updated in process memory (a dict update under
+a lock, cheap enough for the request path). Every `flush_interval` seconds a
+daemon thread writes the process's running totals to a shared SQLite file
+(see shared_state), one row per sample and process; render() flushes the
+calling process, sums the rows of all processes and returns the Prometheus
+text exposition format, so a scrape of any worker sees the whole server.
+
+Rows of workers that have exited are folded into a single "retired" row on
+render(), so counters keep growing across worker restarts without the table
+growing with them. Rows are keyed by pid and process start time, so a new
+process that happens to reuse a dead worker's pid (common in containers) is
+not mistaken for it. A forked worker starts from zero (it never reports its
+parent's counts twice), and gunicorn.conf.py calls clear() when the master
+starts, so a restarted server does not add to the previous run's totals.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+from .shared_state import connect
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    proc TEXT NOT NULL,           -- pid:start time:uuid of the reporting process, or 'retired'
+    name TEXT NOT NULL,           -- sample name, e.g. marvel_stage_seconds_bucket
+    labels TEXT NOT NULL,         -- rendered label set without le
+    le TEXT NOT NULL,             -- histogram bucket bound, '' for other samples
+    value REAL NOT NULL,
+    PRIMARY KEY (proc, name, labels, le)
+);
+"""
+
+FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+# Seconds; spans in-process stages (sub-ms) up to slow model calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+RETIRED = "retired"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    return ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+
+
+def _bound(le: float) -> str:
+    return "+Inf" if le == float("inf") else repr(le)
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _start_time(pid: int) -> str:
+    """Start of process `pid` in clock ticks since boot (Linux), '' where /proc cannot tell."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # Fields after "(comm)"; starttime is the 22nd field of the whole line
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return ""
+
+
+def _alive(proc: str) -> bool:
+    pid, start, _ = proc.split(":", 2)
+    if start:
+        return _start_time(int(pid)) == start
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, registry: "Registry", name: str, help: str, labelnames: Sequence[str] = ()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _reset(self) -> None:
+        self._values = {}
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self.registry._touch():
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        """This process's count for `labels` (render() has the sum over all workers)."""
+        if self.registry._pid != os.getpid():
+            return 0  # nothing recorded in this process yet
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield self.name, _labels(self.labelnames, key), "", value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, labelnames=(), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self.registry._touch():
+            series = self._values.get(key)
+            if series is None:
+                # [count per bucket..., sum]
+                series = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for i, le in enumerate(self.buckets):
+                if value <= le:
+                    series[i] += 1
+                    break
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the with-block, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        for key, series in self._values.items():
+            labels = _labels(self.labelnames, key)
+            cumulative = 0
+            for le, n in zip(self.buckets, series):
+                cumulative += n
+                yield self.name + "_bucket", labels, _bound(le), cumulative
+            yield self.name + "_sum", labels, "", series[-1]
+            yield self.name + "_count", labels, "", cumulative
+
+
+class Registry:
+    def __init__(self, name: str = "metrics", flush_interval: float = FLUSH_INTERVAL):
+        self.name = name
+        self.flush_interval = flush_interval
+        self.metrics: List[_Metric] = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._proc = None
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(self, name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(self, name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def _db(self):
+        return connect(self.name, SCHEMA)
+
+    def _touch(self):
+        """The registry lock; on the first update in a (forked) process, also starts its flusher."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    for metric in self.metrics:
+                        metric._reset()
+                    self._pid = os.getpid()
+                    self._proc = f"{self._pid}:{_start_time(self._pid)}:{uuid.uuid4().hex}"
+                    threading.Thread(target=self._run, name="metrics-flush", daemon=True).start()
+                    atexit.register(self.flush)
+        return self._lock
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("could not flush metrics")
+
+    def flush(self) -> None:
+        """Writes this process's totals to the shared file."""
+        if self._pid != os.getpid():
+            return  # nothing recorded in this process yet
+        with self._lock:
+            rows = [(self._proc, *sample) for metric in self.metrics for sample in metric._samples()]
+        if not rows:
+            return
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(
+                "INSERT OR REPLACE INTO samples (proc, name, labels, le, value) VALUES (?, ?, ?, ?, ?)", rows)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def clear(self) -> None:
+        """Drops every process's rows, retired ones included; for a server that is starting."""
+        self._db().execute("DELETE FROM samples")
+
+    def _retire_dead(self, db) -> None:
+        """Folds rows of processes that no longer exist into the 'retired' row."""
+        if os.name != "posix":
+            return  # os.kill(pid, 0) is not a liveness probe elsewhere
+        dead = []
+        for (proc,) in db.execute("SELECT DISTINCT proc FROM samples WHERE proc != ?", (RETIRED,)):
+            try:
+                if not _alive(proc):
+                    dead.append(proc)
+            except ValueError:
+                dead.append(proc)  # written by an older version (pid:uuid); its process is gone
+        if not dead:
+            return
+        marks = ",".join("?" * len(dead))
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            totals = db.execute(
+                f"SELECT name, labels, le, SUM(value) FROM samples WHERE proc IN ({marks}) "
+                f"GROUP BY name, labels, le", dead).fetchall()
+            db.executemany(
+                "INSERT INTO samples (proc, name, labels, le, value) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (proc, name, labels, le) DO UPDATE SET value = value + excluded.value",
+                [(RETIRED, *row) for row in totals])
+            db.execute(f"DELETE FROM samples WHERE proc IN ({marks})", dead)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def render(self) -> str:
+        """Prometheus text format (version 0.0.4), summed over all workers."""
+        self.flush()
+        db = self._db()
+        self._retire_dead(db)
+        by_name: Dict[str, List[Tuple[str, str, float]]] = {}
+        for name, labels, le, value in db.execute(
+                "SELECT name, labels, le, SUM(value) FROM samples GROUP BY name, labels, le"):
+            by_name.setdefault(name, []).append((labels, le, value))
+
+        def order(sample):
+            labels, le, _ = sample
+            return labels, float(le) if le else 0.0
+
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            suffixes = ("_bucket", "_sum", "_count") if metric.kind == "histogram" else ("",)
+            series: Dict[str, List[Tuple[str, str, str, float]]] = {}
+            for suffix in suffixes:
+                for labels, le, value in sorted(by_name.get(metric.name + suffix, ()), key=order):
+                    series.setdefault(labels, []).append((suffix, labels, le, value))
+            # Keep each label set's bucket/sum/count lines together
+            for labels in sorted(series):
+                for suffix, labels, le, value in series[labels]:
+                    label_set = ",".join(filter(None, (labels, f'le="{le}"' if le else "")))
+                    lines.append(f"{metric.name}{suffix}{{{label_set}}} {_number(value)}"
+                                 if label_set else f"{metric.name}{suffix} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# The process-wide registry used by the app and the add-on modules
+registry = Registry()
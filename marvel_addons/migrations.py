@@ -0,0 +1,59 @@
+"""
+Schema migrations for databases created by an older add-on.
+
+create_all() only creates missing tables, so anything added to an existing
+table is applied here. Every step is idempotent and runs from
+models.ensure_schema; it can also be run by hand:
+
+    python -m marvel_addons.migrations
+"""
+from sqlalchemy import inspect, text
+
+from .models import Message, engine as default_engine
+
+
+def add_message_indexes(conn):
+    existing = {ix["name"] for ix in inspect(conn).get_indexes("messages")}
+    for index in Message.__table__.indexes:
+        if index.name not in existing:
+            index.create(conn)
+
+
+def add_message_level_focus(conn):
+    columns = {col["name"] for col in inspect(conn).get_columns("messages")}
+    if "level" not in columns:
+        conn.execute(text("ALTER TABLE messages ADD COLUMN level VARCHAR(4)"))
+    if "focus" not in columns:
+        conn.execute(text("ALTER TABLE messages ADD COLUMN focus VARCHAR(32)"))
+
+
+def backfill_daily_activity(conn):
+    """Seeds the rollups from existing messages (turn counts only; older rows have no level/focus)."""
+    if conn.execute(text("SELECT 1 FROM daily_activity LIMIT 1")).first():
+        return
+    conn.execute(text(
+        "INSERT INTO daily_activity "
+        "(course_id, user_id, day, turns, general_turns, grammar_turns, a1_turns, a2_turns, b1_turns, b2_turns) "
+        "SELECT course_id, user_id, DATE(ts), COUNT(*), 0, 0, 0, 0, 0, 0 "
+        "FROM messages WHERE role = 'user' AND course_id IS NOT NULL AND user_id IS NOT NULL "
+        "GROUP BY course_id, user_id, DATE(ts)"
+    ))
+
+
+def add_message_search(conn):
+    from .search import install
+    install(conn)
+
+
+STEPS = [add_message_indexes, add_message_level_focus, backfill_daily_activity, add_message_search]
+
+
+def upgrade(engine=default_engine):
+    with engine.begin() as conn:
+        for step in STEPS:
+            step(conn)
+
+
+if __name__ == "__main__":
+    upgrade()
+    print("Database schema is up to date.")
@@ -1,7 +1,8 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, Text, Date, DateTime, ForeignKey, Index
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship, scoped_session
 from datetime import datetime
 import os
+import threading
 
 Base = declarative_base()
 DB_URL = os.getenv("DATABASE_URL", "sqlite:///marvel_chat.db")
@@ -32,15 +33,59 @@ class Message(Base):
     role = Column(String(16))
     content = Column(Text)
     ts = Column(DateTime, default=datetime.utcnow)
+    level = Column(String(4))    # A1–B2 chosen for the turn
+    focus = Column(String(32))   # GENERAL / GRAMMAR_OR_IMPROVEMENT
 
     user = relationship("User", back_populates="messages")
     course = relationship("Course", back_populates="messages")
 
+    # Newest-first pages per course / per student are index range scans (see lti_blueprint._page)
+    __table_args__ = (
+        Index("ix_messages_course_ts_id", "course_id", "ts", "id"),
+        Index("ix_messages_user_ts_id", "user_id", "ts", "id"),
+    )
+
+class DailyActivity(Base):
+    """Per-(course, student, day) turn counts, kept up to date by the history writer."""
+    __tablename__ = "daily_activity"
+    course_id = Column(Integer, ForeignKey("courses.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    turns = Column(Integer, nullable=False, default=0)
+    general_turns = Column(Integer, nullable=False, default=0)
+    grammar_turns = Column(Integer, nullable=False, default=0)
+    a1_turns = Column(Integer, nullable=False, default=0)
+    a2_turns = Column(Integer, nullable=False, default=0)
+    b1_turns = Column(Integer, nullable=False, default=0)
+    b2_turns = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (Index("ix_daily_activity_course_day", "course_id", "day"),)
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+def ensure_schema():
+    """Creates/upgrades the tables once per process, on first database use (or in create_app)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        from .migrations import upgrade
+        from .shared_state import lock
+        # gunicorn workers boot together; only one at a time may create/upgrade the schema
+        with lock("schema"):
+            Base.metadata.create_all(engine)
+            upgrade(engine)
+        _schema_ready = True
+
 def init_db(app):
-    Base.metadata.create_all(engine)
+    ensure_schema()
     @app.teardown_appcontext
     def remove_session(_=None):
         SessionLocal.remove()
 
 def db_session():
+    ensure_schema()
     return SessionLocal
@@ -0,0 +1,150 @@
+"""
+Prompt assembly for /chat.
+
+The request sent to the model is ordered so that everything static comes first
+and is byte-identical between requests:
+
+    1. system: SYSTEM_PROMPT                      (same for everyone)
+    2. system: instruction block for (level, focus) (one of 8, built at startup)
+    3. system: running summary of older turns     (varies per conversation, optional)
+    4. recent history                             (varies per conversation)
+    5. user: the student's message, verbatim      (varies per request)
+
+so 1–2 form a stable prefix the provider can serve from its prompt cache.
+"""
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Dict, Any, Tuple
+
+LEVELS = ("A1", "A2", "B1", "B2")
+FOCUSES = ("GENERAL", "GRAMMAR_OR_IMPROVEMENT")
+DEFAULT_LEVEL = "A2"
+
+_LEVEL_RULES = {
+    "A1": """\
+2. El nivel es A1:
+   - Acepta muchos errores, céntrate en entender la idea.
+   - Puedes señalar UN aspecto sencillo, pero no pidas reescrituras largas
+     salvo que el mensaje sea incomprensible.""",
+    "B1": """\
+2. El nivel es B1. Si el mensaje tiene muchos errores de gramática/sintaxis
+   o está casi todo en inglés:
+   - Pide al estudiante que reescriba la idea en español con mejor forma,
+     sin darle tú la frase corregida.
+   - Ofrece solo pistas o preguntas (“¿acción terminada o habitual?”,
+     “¿qué verbo iría mejor aquí?”).""",
+}
+_LEVEL_RULES["A2"] = _LEVEL_RULES["A1"].replace("A1", "A2")
+_LEVEL_RULES["B2"] = _LEVEL_RULES["B1"].replace("B1", "B2")
+
+_FOCUS_RULES = {
+    "GRAMMAR_OR_IMPROVEMENT": """\
+3. Sobre las MICRO-METAS:
+   - Puedes proponer una micro-meta pequeña y concreta
+     (escribir 2–3 frases, revisar un punto gramatical, etc.).""",
+    "GENERAL": """\
+3. Sobre las MICRO-METAS:
+   - NO propongas micro-metas ni tareas de escritura.""",
+}
+
+
+def normalize_level(level: Any) -> str:
+    level = str(level or "").strip().upper()
+    return level if level in LEVELS else DEFAULT_LEVEL
+
+
+def instruction_block(level: str, focus: str) -> str:
+    """The per-(level, focus) instructions that used to wrap every student message."""
+    return f"""
+Nivel del estudiante: {level}.
+Tipo de consulta: {focus}.
+El mensaje del estudiante es el último mensaje de la conversación
+(puede estar en inglés o español).
+
+
+INSTRUCCIONES PARA TI, MARVEL:
+
+1. Primero, analiza mentalmente si el mensaje corresponde al nivel indicado
+   ({level}), especialmente en sintaxis y tiempos verbales.
+   NO describas este análisis en voz alta.
+
+{_LEVEL_RULES[level]}
+
+{_FOCUS_RULES[focus]}
+
+4. Responde SOLO en español, máximo 150 palabras.
+   Organiza en párrafos cortos o viñetas.
+"""
+
+
+# --- Token counting (tiktoken, from requirements.txt; an estimate if it can't load) ---
+
+# Spanish runs close to 4 chars/token; the fallback assumes 3 so the budget errs short
+FALLBACK_CHARS_PER_TOKEN = 3
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+# History messages are counted again on every turn of their conversation
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    enc = _encoding()
+    if enc is not None:
+        return len(enc.encode(text))
+    return -(-len(text) // FALLBACK_CHARS_PER_TOKEN)
+
+
+def truncate_tokens(text: str, limit: int) -> str:
+    """The longest prefix of `text` that is at most `limit` tokens."""
+    enc = _encoding()
+    if enc is not None:
+        ids = enc.encode(text)
+        return text if len(ids) <= limit else enc.decode(ids[:limit])
+    return text[:limit * FALLBACK_CHARS_PER_TOKEN]
+
+
+SUMMARY_HEADER = (
+    "Memoria de la conversación (resumen de los turnos anteriores; "
+    "úsala como contexto y no la cites):\n"
+)
+
+
+@dataclass
+class PromptStats:
+    fixed_tokens: int
+    variable_tokens: int
+
+
+class PromptAssembler:
+    def __init__(self, system_prompt: str):
+        self.prefixes: Dict[Tuple[str, str], List[Dict[str, str]]] = {}
+        self.fixed_tokens: Dict[Tuple[str, str], int] = {}
+        for level in LEVELS:
+            for focus in FOCUSES:
+                block = instruction_block(level, focus)
+                self.prefixes[(level, focus)] = [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "system", "content": block},
+                ]
+                self.fixed_tokens[(level, focus)] = count_tokens(system_prompt) + count_tokens(block)
+
+    def build(self, user_text: str, level: str, focus: str, history: List[Dict[str, str]],
+              summary: str = "") -> Tuple[List[Dict[str, Any]], PromptStats]:
+        key = (normalize_level(level), focus if focus in FOCUSES else "GENERAL")
+        messages: List[Dict[str, Any]] = list(self.prefixes[key])
+        variable = 0
+        if summary:
+            messages.append({"role": "system", "content": SUMMARY_HEADER + summary})
+            variable += count_tokens(SUMMARY_HEADER) + count_tokens(summary)
+        for h in history:
+            messages.append({"role": h["role"], "content": h["content"]})
+            variable += count_tokens(h["content"])
+        messages.append({"role": "user", "content": user_text})
+        variable += count_tokens(user_text)
+        return messages, PromptStats(self.fixed_tokens[key], variable)
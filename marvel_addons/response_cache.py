@@ -0,0 +1,109 @@
+"""
+Response cache for repeated /chat prompts.
+
+Keyed on the normalized student message + level + focus + a digest of the
+history window sent to the model, so a reply is only reused when the model
+would have seen the same conversation. Entries live in a shared SQLite file
+(see shared_state), so a hit in one gunicorn worker helps the others; they
+expire after `ttl` seconds and the least recently used are evicted past
+`max_entries`.
+
+A lookup only reads the shared file: hits and misses are counted in process
+memory (summed over workers in /metrics), and an entry's last_used is only
+rewritten once it is more than TOUCH_FRACTION of the TTL old, which is
+precise enough for LRU eviction.
+"""
+import hashlib
+import json
+import re
+import time
+import unicodedata
+from typing import List, Dict, Optional
+
+from .metrics import registry
+from .shared_state import connect
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    reply TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_entries_last_used ON entries (last_used);
+CREATE INDEX IF NOT EXISTS ix_entries_expires_at ON entries (expires_at);
+"""
+
+LOOKUPS = registry.counter(
+    "marvel_response_cache_lookups_total", "Response cache lookups, by result (hit, miss)", ["result"])
+
+# last_used is rewritten at most once per this share of the TTL
+TOUCH_FRACTION = 0.1
+
+_SPACES = re.compile(r"\s+")
+_EDGE_PUNCT = "¿?¡!.,;: "
+
+
+def normalize(text: str) -> str:
+    """'  ¿Qué  es el SUBJUNTIVO? ' -> 'qué es el subjuntivo'"""
+    text = unicodedata.normalize("NFC", text).casefold()
+    return _SPACES.sub(" ", text).strip(_EDGE_PUNCT)
+
+
+def history_digest(history: List[Dict[str, str]]) -> str:
+    raw = json.dumps([[h["role"], h["content"]] for h in history], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+class ResponseCache:
+    def __init__(self, name: str = "response_cache", ttl: float = 3600, max_entries: int = 5000):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def _db(self):
+        return connect(self.name, SCHEMA)
+
+    def key(self, user_text: str, level: str, focus: str, history: List[Dict[str, str]]) -> str:
+        raw = "\x1f".join([level, focus, normalize(user_text), history_digest(history)])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        db = self._db()
+        now = time.time()
+        row = db.execute("SELECT reply, expires_at, last_used FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] <= now:
+            LOOKUPS.inc(result="miss")
+            return None
+        if now - row[2] > self.ttl * TOUCH_FRACTION:
+            db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+        LOOKUPS.inc(result="hit")
+        return row[0]
+
+    def put(self, key: str, reply: str) -> None:
+        if not self.enabled:
+            return
+        db = self._db()
+        now = time.time()
+        db.execute(
+            "INSERT OR REPLACE INTO entries (key, reply, expires_at, last_used) VALUES (?, ?, ?, ?)",
+            (key, reply, now + self.ttl, now),
+        )
+        db.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+        db.execute(
+            "DELETE FROM entries WHERE key IN "
+            "(SELECT key FROM entries ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def stats(self) -> Dict[str, int]:
+        """This worker's hits and misses, and the entries of all workers."""
+        size = self._db().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {"hits": int(LOOKUPS.value(result="hit")), "misses": int(LOOKUPS.value(result="miss")),
+                "entries": size}
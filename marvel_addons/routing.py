@@ -0,0 +1,131 @@
+"""
+Routing of /chat messages, right after detect_focus.
+
+Each message goes to one of:
+- a local template: a fixed reply for messages the system prompt already
+  answers almost word for word (greetings, "¿qué eres?", personal problems
+  and crises), with no model call, no quota and no wait;
+- a model tier chosen by focus: by default GENERAL goes to the "small"
+  model and GRAMMAR_OR_IMPROVEMENT to the "full" one.
+
+The rules live in a JSON file (routing.json next to app.py, or
+ROUTING_CONFIG) so they can be tuned without touching code:
+
+    {
+      "models": {"small": {"model": "gpt-4o-mini"},
+                 "full":  {"model": null}},               # null = LLM_MODEL
+      "prices": {"gpt-4o-mini": {"input_per_1m": 0.15, "output_per_1m": 0.6}, ...},
+      "focus":  {"GENERAL": "small", "GRAMMAR_OR_IMPROVEMENT": "full"},
+      "templates": [
+        {"name": "crisis", "match": "any", "patterns": ["no quiero vivir mas", "suicidarme"],
+         "replies": ["..."]},
+        {"name": "greeting", "match": "only", "focus": ["GENERAL"],
+         "patterns": ["hola", "buenos dias", "marvel"], "replies": ["...", "..."]}
+      ]
+    }
+
+Templates are tried in file order and the first match wins. Patterns use
+the FOCUS_KEYWORDS syntax (accents and case ignored, whole words, a trailing
+* matches any ending). "any" matches a pattern anywhere in the message;
+"only" matches when the message is nothing but patterns and punctuation, so
+"hola marvel!" is a greeting but "hola, ¿qué es el subjuntivo?" is not. An
+optional "focus" list restricts a template to those focuses. Prices (USD
+per million tokens) are looked up by the model each tier resolves to, so a
+null tier is priced as whatever LLM_MODEL is; they only feed the cost
+counter in /metrics, and a model missing from the table counts as free.
+"""
+import json
+import logging
+import random
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from .focus import GENERAL, GRAMMAR, fold, _trie_regex
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONFIG: Dict[str, Any] = {
+    "models": {"full": {"model": None}},
+    "focus": {GENERAL: "full", GRAMMAR: "full"},
+    "templates": [],
+}
+
+
+@dataclass
+class Tier:
+    name: str
+    model: str
+    input_per_1m: float = 0.0
+    output_per_1m: float = 0.0
+
+    def cost(self, prompt_tokens: int, completion_tokens: int) -> float:
+        return (prompt_tokens * self.input_per_1m + completion_tokens * self.output_per_1m) / 1e6
+
+
+@dataclass
+class Template:
+    name: str
+    pattern: re.Pattern
+    replies: List[str]
+    focus: Optional[List[str]] = None
+
+    def matches(self, folded: str, focus: str) -> bool:
+        if self.focus and focus not in self.focus:
+            return False
+        return self.pattern.search(folded) is not None
+
+
+@dataclass
+class Route:
+    """Where one message goes: `reply` for a template, otherwise `tier`."""
+    name: str
+    tier: Optional[Tier] = None
+    reply: Optional[str] = None
+
+
+def _template(rule: Dict[str, Any]) -> Template:
+    patterns = [" ".join(fold(p).split()) for p in rule["patterns"]]
+    body = _trie_regex(patterns)
+    if rule.get("match", "any") == "only":
+        regex = rf"^\W*(?:{body})(?:\W+(?:{body}))*\W*$"
+    else:
+        regex = rf"\b{body}\b"
+    return Template(rule["name"], re.compile(regex), list(rule["replies"]), rule.get("focus"))
+
+
+def _tier(name: str, model: str, prices: Dict[str, Dict[str, float]]) -> Tier:
+    price = prices.get(model)
+    if price is None:
+        log.warning("routing: no price for model %s (tier %s); its cost is counted as 0", model, name)
+        return Tier(name, model)
+    return Tier(name, model, float(price.get("input_per_1m", 0)), float(price.get("output_per_1m", 0)))
+
+
+class Router:
+    def __init__(self, config: Dict[str, Any], default_model: str):
+        self.tiers = {
+            name: _tier(name, spec.get("model") or default_model, config.get("prices", {}))
+            for name, spec in config["models"].items()
+        }
+        self.by_focus = {focus: self.tiers[tier] for focus, tier in config["focus"].items()}
+        self.templates = [_template(rule) for rule in config.get("templates", [])]
+
+    @classmethod
+    def from_file(cls, path: str, default_model: str) -> "Router":
+        """Router for the rules in `path`; everything goes to `default_model` if it is missing."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            log.warning("routing config %s not found; every message goes to %s", path, default_model)
+            config = DEFAULT_CONFIG
+        return cls(config, default_model)
+
+    def route(self, user_text: str, focus: str) -> Route:
+        folded = fold(user_text)
+        for template in self.templates:
+            if template.matches(folded, focus):
+                return Route(template.name, reply=random.choice(template.replies))
+        tier = self.by_focus.get(focus) or self.by_focus[GENERAL]
+        return Route(tier.name, tier=tier)
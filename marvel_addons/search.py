@@ -0,0 +1,136 @@
+"""
+Accent-insensitive full-text search over Message.content.
+
+SQLite:     an FTS5 index (unicode61, remove_diacritics 2) over messages,
+            kept in sync by triggers; the course id is an indexed FTS column,
+            so the course filter is part of the index lookup.
+PostgreSQL: a GIN expression index on to_tsvector('marvel_es', content), where
+            marvel_es is the Spanish configuration with unaccent in front of
+            the stemmer; being an expression index, it is always in sync.
+Others:     falls back to a LIKE scan (works, but not at scale).
+
+install() is a migration step; search() serves /lti/search/course.
+"""
+import re
+
+from sqlalchemy import text
+
+SNIPPET_START, SNIPPET_END = "«", "»"
+
+_SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, course_id,
+        content='messages', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, content, course_id) VALUES (new.id, new.content, new.course_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content, course_id)
+        VALUES ('delete', old.id, old.content, old.course_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content, course_id)
+        VALUES ('delete', old.id, old.content, old.course_id);
+        INSERT INTO messages_fts (rowid, content, course_id) VALUES (new.id, new.content, new.course_id);
+    END""",
+]
+
+_POSTGRES_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    """DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = 'marvel_es') THEN
+            CREATE TEXT SEARCH CONFIGURATION marvel_es (COPY = spanish);
+            ALTER TEXT SEARCH CONFIGURATION marvel_es
+                ALTER MAPPING FOR hword, hword_part, word WITH unaccent, spanish_stem;
+        END IF;
+    END $$""",
+    """CREATE INDEX IF NOT EXISTS ix_messages_content_fts
+        ON messages USING GIN (to_tsvector('marvel_es', coalesce(content, '')))""",
+]
+
+
+def install(conn):
+    """Migration step: creates the index (and fills it once on SQLite)."""
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        exists = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")).first()
+        for ddl in _SQLITE_DDL:
+            conn.execute(text(ddl))
+        if not exists:
+            conn.execute(text("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"))
+    elif dialect == "postgresql":
+        for ddl in _POSTGRES_DDL:
+            conn.execute(text(ddl))
+
+
+_TERM = re.compile(r"[^\s\"]+\*?")
+
+
+def _fts5_query(course_pk, q):
+    """'pretérito subj*' -> 'course_id:"12" AND "pretérito" AND "subj"*' (no FTS syntax from users)."""
+    terms = []
+    for term in _TERM.findall(q):
+        prefix = term.endswith("*")
+        term = term.rstrip("*")
+        if term:
+            terms.append(f'"{term}"' + ("*" if prefix else ""))
+    if not terms:
+        return None
+    return f'course_id:"{course_pk}" AND ' + " AND ".join(terms)
+
+
+def _iso(ts):
+    # SQLite hands raw text back through text() queries
+    return ts.isoformat() if hasattr(ts, "isoformat") else str(ts).replace(" ", "T", 1)
+
+
+def search(db, course_pk, q, limit=20, offset=0, user_pk=None):
+    """Ranked matches in one course: [{id, role, ts, lms_user_id, snippet}], best first."""
+    dialect = db.get_bind().dialect.name
+    params = {"course": course_pk, "limit": limit, "offset": offset, "user": user_pk}
+    student = " AND m.user_id = :user" if user_pk is not None else ""
+
+    if dialect == "sqlite":
+        params["q"] = _fts5_query(course_pk, q)
+        if params["q"] is None:
+            return []
+        sql = f"""
+            SELECT m.id, m.role, m.ts, u.lms_user_id,
+                   snippet(messages_fts, 0, '{SNIPPET_START}', '{SNIPPET_END}', '…', 16) AS snippet
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            LEFT JOIN users u ON u.id = m.user_id
+            WHERE messages_fts MATCH :q{student}
+            ORDER BY bm25(messages_fts)
+            LIMIT :limit OFFSET :offset"""
+    elif dialect == "postgresql":
+        params["q"] = q
+        sql = f"""
+            SELECT m.id, m.role, m.ts, u.lms_user_id,
+                   ts_headline('marvel_es', m.content, query,
+                               'StartSel={SNIPPET_START}, StopSel={SNIPPET_END}, MaxWords=20, MinWords=8') AS snippet
+            FROM messages m
+            CROSS JOIN websearch_to_tsquery('marvel_es', :q) AS query
+            LEFT JOIN users u ON u.id = m.user_id
+            WHERE to_tsvector('marvel_es', coalesce(m.content, '')) @@ query
+              AND m.course_id = :course{student}
+            ORDER BY ts_rank(to_tsvector('marvel_es', coalesce(m.content, '')), query) DESC, m.id DESC
+            LIMIT :limit OFFSET :offset"""
+    else:
+        params["q"] = f"%{q}%"
+        sql = f"""
+            SELECT m.id, m.role, m.ts, u.lms_user_id, m.content AS snippet
+            FROM messages m
+            LEFT JOIN users u ON u.id = m.user_id
+            WHERE m.course_id = :course AND m.content LIKE :q{student}
+            ORDER BY m.ts DESC, m.id DESC
+            LIMIT :limit OFFSET :offset"""
+
+    rows = db.execute(text(sql), params).mappings().all()
+    return [
+        {"id": r["id"], "role": r["role"], "ts": _iso(r["ts"]),
+         "lms_user_id": r["lms_user_id"], "snippet": r["snippet"]}
+        for r in rows
+    ]
@@ -0,0 +1,63 @@
+"""
+Small SQLite files shared by every gunicorn worker on the same machine.
+
+Each feature gets its own file under MARVEL_STATE_DIR, opened in WAL mode so
+readers never block the writer. Connections are per thread and per process
+(a forked worker never reuses its parent's handle).
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock (single dev server anyway)
+    fcntl = None
+
+STATE_DIR = os.getenv("MARVEL_STATE_DIR", os.path.join(tempfile.gettempdir(), "marvel_state"))
+
+_local = threading.local()
+
+# Files this process has already switched to WAL and given their schema
+_ready = set()
+
+
+def connect(name: str, schema: str = "") -> sqlite3.Connection:
+    """Returns this thread's connection to STATE_DIR/<name>.db, creating `schema` once."""
+    pid = os.getpid()
+    if getattr(_local, "pid", None) != pid:
+        _local.pid = pid
+        _local.conns = {}
+
+    conn = _local.conns.get(name)
+    if conn is None:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(STATE_DIR, f"{name}.db"), timeout=5, isolation_level=None)
+        if name not in _ready:
+            # Switching to WAL needs the file to itself: workers opening a fresh
+            # state dir at the same time would get "database is locked"
+            with lock(name):
+                conn.execute("PRAGMA journal_mode=WAL")
+                if schema:
+                    conn.executescript(schema)
+            _ready.add(name)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conns[name] = conn
+    return conn
+
+
+@contextmanager
+def lock(name: str):
+    """Exclusive lock across every process on this machine, e.g. for schema setup at boot."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(os.path.join(STATE_DIR, f"{name}.lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
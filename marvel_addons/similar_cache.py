@@ -0,0 +1,296 @@
+"""
+Near-duplicate cache for first-turn /chat questions.
+
+The response cache only matches the same message after normalize(), so
+"que es el subjuntivo", "Hola Marvel, ¿qué es el subjuntivo, porfa?" and
+"el subjuntivo, ¿qué es?" each pay for a model call. Here a first-turn
+question (no history, no summary) that says the same as a recent one of the
+same level and focus gets that question's reply:
+
+- questions are folded (case, accents), stripped of punctuation and of
+  FILLER words, and padded with spaces, so trigrams also mark word edges;
+- a hit needs a Jaccard index of the two trigram sets of at least
+  `threshold`, so "que es subjuntivo" ~ "que es el subjuntivo" (0.76) and
+  reorderings such as "el subjuntivo, ¿qué es?" (0.91) are answered;
+- and it must pass a minimal-pair guard: the words that differ between the
+  two questions may only be OPTIONAL ones (articles, "oye", "pues"...).
+  Grammar questions often differ in a single word and need different
+  answers: "¿está bien decir yo soy cansado?" / "... yo estoy cansado?"
+  score 0.82, "¿por qué se usa subjuntivo después de creo que?" / "... de
+  no creo que?" 0.89, "¿cómo es el pretérito de ir?" / "... de ser?" 0.77.
+  A differing verb, negation, grammar term or noun is therefore a miss
+  whatever the score, and so is a typo, which can't be told apart from a
+  real word ("casado" / "cansado");
+- an inverted index (trigram -> entries) per (level, focus) finds the
+  candidates; only the rarest trigrams of a question are probed, enough
+  that nothing scoring above SCORE_FLOOR can be missed (prefix filtering);
+- entries live in process memory, least recently used first out once their
+  estimated size passes `max_bytes`, and expire after `ttl` seconds.
+
+A threshold of 0 turns the cache off (app.py reads SIMILAR_CACHE_THRESHOLD,
+0.7 by default).
+
+get() is called on an exact-cache miss and remembers the question under the
+request's cache key; put() then stores the reply the model gave for it, so
+only questions that were actually answered are indexed. Each gunicorn worker
+keeps its own cache.
+
+Every lookup is counted in /metrics by decision, and its best score goes to
+a histogram. With `log_path` each decision (question, closest match, score,
+whether the guard let it through, threshold) is also appended to a JSON-lines
+file, and
+
+    python -m marvel_addons.similar_cache decisions.jsonl
+
+shows how many lookups each threshold would answer, and the pairs closest
+to the current one, for tuning it offline.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Optional, Set, Tuple
+
+from .focus import fold
+from .metrics import registry
+
+log = logging.getLogger(__name__)
+
+LOOKUPS = registry.counter(
+    "marvel_similar_cache_lookups_total", "First-turn similarity lookups, by decision (hit, miss, skipped)",
+    ["decision"])
+SCORES = registry.histogram(
+    "marvel_similar_cache_score", "Best similarity of the first-turn lookups that found a candidate",
+    buckets=(0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 1.0))
+
+# Greetings, names and politeness that say nothing about the question
+FILLER = frozenset({"hola", "marvel", "porfa", "porfis", "porfavor", "please", "plis", "pls", "gracias"})
+# Words two questions may differ in and still ask the same thing; any other
+# differing word (verb, negation, grammar term, noun) makes them a minimal pair
+OPTIONAL = frozenset({"el", "la", "los", "las", "un", "una", "unos", "unas",
+                      "oye", "pues", "entonces", "exactamente", "realmente", "profe", "profesora"})
+_WORDS = re.compile(r"\w+")
+
+# Lowest score still looked for (and logged) below the threshold
+SCORE_FLOOR = 0.5
+# Bookkeeping bytes per entry and per trigram (set slot + index posting), roughly
+ENTRY_BYTES = 400
+GRAM_BYTES = 120
+# Questions waiting for their reply (a failed call never comes back)
+MAX_PENDING = 1000
+
+Scope = Tuple[str, str]
+
+
+def normalize(text: str) -> str:
+    """'¿Qué es el SUBJUNTIVO, porfa?' -> 'que es el subjuntivo'"""
+    words = _WORDS.findall(fold(text).replace("por favor", " "))
+    return " ".join(w for w in words if w not in FILLER)
+
+
+def trigrams(normalized: str) -> FrozenSet[str]:
+    padded = f" {normalized} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared) if shared else 0.0
+
+
+@dataclass
+class _Question:
+    scope: Scope
+    text: str
+    words: FrozenSet[str]  # without OPTIONAL ones; equal sets pass the minimal-pair guard
+    grams: FrozenSet[str]
+
+
+@dataclass
+class _Entry:
+    question: _Question
+    reply: str
+    expires_at: float
+    size: int
+
+
+class SimilarQuestionCache:
+    def __init__(self, threshold: float = 0.7, ttl: float = 3600, max_bytes: int = 8 * 2 ** 20,
+                 min_chars: int = 12, max_chars: int = 300, log_path: Optional[str] = None):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.log_path = log_path
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()  # LRU order, oldest first
+        self._index: Dict[Scope, Dict[str, Set[int]]] = {}
+        self._pending: "OrderedDict[str, _Question]" = OrderedDict()  # cache key -> question
+        self._next_id = 0
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+        self._log_file = None
+        self._log_pid = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0 and self.ttl > 0 and self.max_bytes > 0
+
+    # --- lookup ---
+
+    def get(self, key: str, user_text: str, level: str, focus: str) -> Optional[str]:
+        """Reply to a question like `user_text`, or None (then put(key, ...) stores this one's reply)."""
+        if not self.enabled:
+            return None
+        text = normalize(user_text)
+        if not self.min_chars <= len(text) <= self.max_chars:
+            LOOKUPS.inc(decision="skipped")
+            return None
+        question = _Question((level, focus), text, frozenset(text.split()) - OPTIONAL, trigrams(text))
+        with self._lock:
+            match, score = self._closest(question, time.time())
+            entry = self._entries[match] if match is not None else None
+            guard_ok = entry is not None and entry.question.words == question.words
+            if guard_ok and score >= self.threshold:
+                self._entries.move_to_end(match)
+                reply, decision = entry.reply, "hit"
+                self._hits += 1
+            else:
+                reply, decision = None, "miss"
+                self._misses += 1
+                self._pending[key] = question
+                self._pending.move_to_end(key)
+                while len(self._pending) > MAX_PENDING:
+                    self._pending.popitem(last=False)
+        LOOKUPS.inc(decision=decision)
+        if entry is not None:
+            SCORES.observe(score)
+        self._log_decision(question, entry.question.text if entry else None, score, guard_ok, decision)
+        return reply
+
+    def _closest(self, question: _Question, now: float) -> Tuple[Optional[int], float]:
+        """
+        (entry id, score) of the most similar live entry, preferring those that
+        pass the minimal-pair guard, or (None, 0.0) if none reaches SCORE_FLOOR.
+        """
+        index = self._index.get(question.scope)
+        if not index:
+            return None, 0.0
+        floor = min(self.threshold, SCORE_FLOOR)
+        grams = sorted(question.grams, key=lambda g: len(index.get(g, ())))
+        # Jaccard >= floor needs ceil(floor * |q|) shared trigrams, so any
+        # candidate shares one of the |q| - that + 1 rarest
+        probe = grams[:len(grams) - math.ceil(floor * len(grams)) + 1]
+        candidates = set()
+        for g in probe:
+            candidates.update(index.get(g, ()))
+        best, best_rank = None, (False, 0.0)
+        for entry_id in candidates:
+            entry = self._entries[entry_id]
+            if entry.expires_at <= now:
+                self._remove(entry_id)
+                continue
+            rank = (entry.question.words == question.words, jaccard(question.grams, entry.question.grams))
+            if rank > best_rank:
+                best, best_rank = entry_id, rank
+        score = best_rank[1]
+        return (best, score) if score >= floor else (None, 0.0)
+
+    # --- store ---
+
+    def put(self, key: str, reply: str) -> None:
+        """Indexes the question get() saw under `key` with the model's reply to it."""
+        with self._lock:
+            question = self._pending.pop(key, None)
+            if question is None:
+                return
+            size = (ENTRY_BYTES + GRAM_BYTES * len(question.grams)
+                    + len(question.text.encode("utf-8")) + len(reply.encode("utf-8")))
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = _Entry(question, reply, time.time() + self.ttl, size)
+            index = self._index.setdefault(question.scope, {})
+            for g in question.grams:
+                index.setdefault(g, set()).add(entry_id)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        index = self._index[entry.question.scope]
+        for g in entry.question.grams:
+            postings = index[g]
+            postings.discard(entry_id)
+            if not postings:
+                del index[g]
+        self._bytes -= entry.size
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses,
+                    "entries": len(self._entries), "bytes": self._bytes}
+
+    # --- decision log ---
+
+    def _log_decision(self, question: _Question, match: Optional[str], score: float, guard_ok: bool,
+                      decision: str) -> None:
+        level, focus = question.scope
+        log.debug("similar cache %s: %.3f %r ~ %r (%s, %s)", decision, score, question.text, match, level, focus)
+        if not self.log_path:
+            return
+        line = json.dumps({"ts": round(time.time(), 3), "level": level, "focus": focus,
+                           "question": question.text, "match": match, "score": round(score, 4),
+                           "guard_ok": guard_ok, "threshold": self.threshold, "decision": decision},
+                          ensure_ascii=False)
+        with self._lock:
+            if self._log_pid != os.getpid():
+                # Opened per process; appends of one short line do not interleave between workers
+                self._log_file = open(self.log_path, "a", encoding="utf-8", buffering=1)
+                self._log_pid = os.getpid()
+            self._log_file.write(line + "\n")
+
+
+# ==================== OFFLINE TUNING ====================
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Replay a SIMILAR_CACHE_LOG against other thresholds.")
+    parser.add_argument("log", help="JSON-lines decision log")
+    parser.add_argument("--thresholds", default="0.5,0.55,0.6,0.65,0.7,0.75,0.8,0.85,0.9,0.95")
+    parser.add_argument("--pairs", type=int, default=15, help="closest pairs to show around the threshold")
+    args = parser.parse_args(argv)
+
+    with open(args.log, encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    rows = [r for r in rows if r["decision"] != "skipped"]
+    if not rows:
+        print("no lookups in the log")
+        return 0
+    current = rows[-1]["threshold"]
+    print(f"{len(rows)} lookups, logged at threshold {current:g}")
+    print("threshold  would hit  share")
+    for t in sorted(float(t) for t in args.thresholds.split(",")):
+        hits = sum(r["match"] is not None and r.get("guard_ok", False) and r["score"] >= t for r in rows)
+        print(f"{t:>9g}  {hits:>9}  {hits / len(rows):>5.1%}")
+
+    # Pairs just above and below the current threshold are the ones to read
+    near = sorted((r for r in rows if r["match"] is not None), key=lambda r: abs(r["score"] - current))
+    print(f"\nclosest to {current:g}:")
+    for r in sorted(near[:args.pairs], key=lambda r: -r["score"]):
+        words = "" if r.get("guard_ok") else " (minimal pair)"
+        print(f"  {r['score']:.3f} {'hit ' if r['decision'] == 'hit' else 'miss'} "
+              f"[{r['level']} {r['focus']}] {r['question']!r} ~ {r['match']!r}{words}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
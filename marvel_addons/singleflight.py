@@ -0,0 +1,344 @@
+"""
+Coalescing of identical in-flight model calls ("singleflight").
+
+When a class is told to ask the same question, dozens of identical /chat
+requests (same level, focus, history, i.e. the same assembled `messages`)
+arrive before any answer exists, so the response cache cannot help yet. Here
+the first caller for a key becomes the leader and makes the upstream call;
+everyone else with the same key waits for the leader's result instead of
+paying for their own call.
+
+Two layers:
+- in-process: followers wait on the leader's Event (threads) or Future
+  (asyncio), so a process has at most one caller per key touching the layer
+  below;
+- across workers: leadership is a row in a shared SQLite file (see
+  shared_state); followers in other processes poll that row until the
+  leader publishes.
+
+Semantics:
+- the leader's result is handed to every follower;
+- if the leader's call raises, followers get the error too (the same
+  exception in-process, SingleflightError across processes) rather than each
+  retrying against an upstream that is failing;
+- a follower waits at most `timeout` seconds, then makes its own call; the
+  same happens if the leader goes away without an answer (abandon(), or a
+  crashed worker whose row is older than `timeout`).
+
+do()/ado() wrap a whole call. lead()/alead() are for streaming leaders, who
+publish the text they streamed once they are done. The async variants do
+their SQLite reads and writes in worker threads, off the event loop.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from .shared_state import connect
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS flights (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    state TEXT NOT NULL,          -- pending | done | error | abandoned
+    value TEXT,
+    started_at REAL NOT NULL
+);
+"""
+
+_FOLLOW_YOURSELF = object()  # leader gave up without an answer: call it yourself
+
+
+class SingleflightError(Exception):
+    """A leader in another process failed; carries its error message."""
+
+
+class _Call:
+    """One in-process flight: the leader's outcome, for local followers."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class Lease:
+    """Held by a streaming leader; publish() or abandon() exactly once."""
+
+    def __init__(self, flights: "Singleflight", key: str, owner: str, local):
+        self._flights = flights
+        self.key = key
+        self.owner = owner
+        self._local = local
+        self._closed = False
+
+    def publish(self, value: Any) -> None:
+        self._close("done", value=value)
+
+    def fail(self, error: BaseException) -> None:
+        self._close("error", error=error)
+
+    def abandon(self) -> None:
+        self._close("abandoned")
+
+    async def apublish(self, value: Any) -> None:
+        await self._aclose("done", value=value)
+
+    async def aabandon(self) -> None:
+        await self._aclose("abandoned")
+
+    def _close(self, state, value=None, error=None) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._flights._publish(self.key, self.owner, state, value, error)
+        self._flights._finish_local(self.key, self._local, state, value, error)
+
+    async def _aclose(self, state, value=None, error=None) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await asyncio.to_thread(self._flights._publish, self.key, self.owner, state, value, error)
+        finally:
+            # Futures are resolved on the loop's own thread, even if this await is cancelled
+            self._flights._finish_local(self.key, self._local, state, value, error)
+
+
+class Singleflight:
+    def __init__(self, name: str = "singleflight", timeout: float = 60.0, poll_interval: float = 0.05):
+        self.name = name
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._futures: Dict[str, asyncio.Future] = {}
+        self.stats = {"leaders": 0, "followers": 0, "remote_followers": 0, "timeouts": 0, "errors": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def _db(self):
+        return connect(self.name, SCHEMA)
+
+    @staticmethod
+    def key(model: str, messages: List[Dict[str, Any]]) -> str:
+        raw = json.dumps([model, messages], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    # --- shared (cross-process) layer ---
+
+    def _claim(self, key: str) -> Optional[str]:
+        """Owner token if this process now leads `key` across workers, else None."""
+        owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+        now = time.time()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT state, started_at FROM flights WHERE key = ?", (key,)).fetchone()
+            free = row is None or row[0] != "pending" or row[1] < now - self.timeout
+            if free:
+                db.execute(
+                    "INSERT OR REPLACE INTO flights (key, owner, state, value, started_at) "
+                    "VALUES (?, ?, 'pending', NULL, ?)", (key, owner, now))
+            if random.random() < 0.01:
+                db.execute("DELETE FROM flights WHERE started_at < ?", (now - 2 * self.timeout,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return owner if free else None
+
+    def _publish(self, key: str, owner: str, state: str, value=None, error=None) -> None:
+        payload = json.dumps(value) if state == "done" else (repr(error) if error else None)
+        try:
+            self._db().execute(
+                "UPDATE flights SET state = ?, value = ? WHERE key = ? AND owner = ?",
+                (state, payload, key, owner))
+        except Exception as e:  # followers will time out and call for themselves
+            log.warning("singleflight publish failed: %r", e)
+
+    def _check(self, key: str, deadline: float):
+        """The remote outcome if there is one yet; None while still pending."""
+        row = self._db().execute("SELECT state, value, started_at FROM flights WHERE key = ?", (key,)).fetchone()
+        if row is None or row[0] == "abandoned":
+            return _FOLLOW_YOURSELF
+        state, value, started_at = row
+        if state == "done":
+            return json.loads(value)
+        if state == "error":
+            raise SingleflightError(value)
+        if time.monotonic() >= deadline or started_at < time.time() - self.timeout:
+            self._count("timeouts")
+            return _FOLLOW_YOURSELF
+        return None
+
+    def _follow_remote(self, key: str, fn: Callable[[], Any]) -> Any:
+        self._count("remote_followers")
+        deadline = time.monotonic() + self.timeout
+        while True:
+            outcome = self._check(key, deadline)
+            if outcome is _FOLLOW_YOURSELF:
+                return fn()
+            if outcome is not None:
+                return outcome
+            time.sleep(self.poll_interval)
+
+    async def _afollow_remote(self, key: str, afn: Callable[[], Awaitable[Any]]) -> Any:
+        self._count("remote_followers")
+        deadline = time.monotonic() + self.timeout
+        while True:
+            outcome = await asyncio.to_thread(self._check, key, deadline)
+            if outcome is _FOLLOW_YOURSELF:
+                return await afn()
+            if outcome is not None:
+                return outcome
+            await asyncio.sleep(self.poll_interval)
+
+    def _lead_remote(self, key: str, owner: str, fn: Callable[[], Any]) -> Any:
+        self._count("leaders")
+        try:
+            value = fn()
+        except BaseException as e:
+            self._count("errors")
+            self._publish(key, owner, "error", error=e)
+            raise
+        self._publish(key, owner, "done", value)
+        return value
+
+    async def _alead_remote(self, key: str, owner: str, afn: Callable[[], Awaitable[Any]]) -> Any:
+        self._count("leaders")
+        try:
+            value = await afn()
+        except asyncio.CancelledError:
+            # Synchronous: awaiting here could be cancelled again and leave the row pending
+            self._publish(key, owner, "abandoned")
+            raise
+        except BaseException as e:
+            self._count("errors")
+            await asyncio.to_thread(self._publish, key, owner, "error", None, e)
+            raise
+        await asyncio.to_thread(self._publish, key, owner, "done", value)
+        return value
+
+    # --- in-process layer ---
+
+    def _finish_local(self, key: str, local, state: str, value=None, error=None) -> None:
+        if local is None:
+            return
+        if isinstance(local, _Call):
+            with self._lock:
+                if self._calls.get(key) is local:
+                    del self._calls[key]
+            local.value = value if state == "done" else _FOLLOW_YOURSELF if state == "abandoned" else None
+            local.error = error
+            local.event.set()
+        else:
+            if self._futures.get(key) is local:
+                del self._futures[key]
+            if not local.done():
+                if state == "error":
+                    local.set_exception(error)
+                    local.exception()  # followers may be gone; don't warn "never retrieved"
+                else:
+                    local.set_result(value if state == "done" else _FOLLOW_YOURSELF)
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """fn() once per key across all threads and workers; everyone gets its result."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            self._count("followers")
+            if not call.event.wait(self.timeout):
+                self._count("timeouts")
+                return fn()
+            if call.error is not None:
+                raise call.error
+            return fn() if call.value is _FOLLOW_YOURSELF else call.value
+
+        try:
+            owner = self._claim(key)
+            value = self._lead_remote(key, owner, fn) if owner else self._follow_remote(key, fn)
+        except BaseException as e:
+            self._finish_local(key, call, "error", error=e)
+            raise
+        self._finish_local(key, call, "done", value)
+        return value
+
+    async def ado(self, key: str, afn: Callable[[], Awaitable[Any]]) -> Any:
+        """Async twin of do(); `afn` is a coroutine function."""
+        future = self._futures.get(key)
+        if future is not None:
+            self._count("followers")
+            try:
+                value = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except asyncio.TimeoutError:
+                self._count("timeouts")
+                return await afn()
+            return await afn() if value is _FOLLOW_YOURSELF else value
+
+        future = self._futures[key] = asyncio.get_running_loop().create_future()
+        try:
+            owner = await asyncio.to_thread(self._claim, key)
+            value = await (self._alead_remote(key, owner, afn) if owner else self._afollow_remote(key, afn))
+        except asyncio.CancelledError:
+            self._finish_local(key, future, "abandoned")
+            raise
+        except BaseException as e:
+            self._finish_local(key, future, "error", error=e)
+            raise
+        self._finish_local(key, future, "done", value)
+        return value
+
+    def lead(self, key: str) -> Optional[Lease]:
+        """A Lease if nobody is computing `key` yet (this caller leads), else None."""
+        with self._lock:
+            if key in self._calls:
+                return None
+            # Registered before the claim, so local callers arriving meanwhile follow this one;
+            # the claim itself waits on the shared file and must not hold up other keys
+            call = self._calls[key] = _Call()
+        try:
+            owner = self._claim(key)
+        except BaseException:
+            self._finish_local(key, call, "abandoned")
+            raise
+        if owner is None:
+            self._finish_local(key, call, "abandoned")
+            return None
+        self._count("leaders")
+        return Lease(self, key, owner, call)
+
+    async def alead(self, key: str) -> Optional[Lease]:
+        """lead() for coroutines on the event loop."""
+        if key in self._futures:
+            return None
+        # Registered before the claim, so local callers arriving meanwhile follow this one
+        future = self._futures[key] = asyncio.get_running_loop().create_future()
+        try:
+            owner = await asyncio.to_thread(self._claim, key)
+        except BaseException:
+            self._finish_local(key, future, "abandoned")
+            raise
+        if owner is None:
+            self._finish_local(key, future, "abandoned")
+            return None
+        self._count("leaders")
+        return Lease(self, key, owner, future)
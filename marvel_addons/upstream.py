@@ -0,0 +1,369 @@
+"""
+Resilient access to the model for /chat.
+
+- Remembers which API works: the Responses API is tried first, and if the
+  account/proxy does not support it the client switches to Chat Completions
+  for the rest of the process instead of paying two round trips per request.
+- Retries transient errors (connection, timeout, 429, 5xx) with jittered
+  exponential backoff, all inside one per-request deadline.
+- A circuit breaker fails fast with a friendly message after repeated
+  failures, so a degraded provider does not pin every worker thread.
+
+call/stream are used by the Flask app, acall/astream by asgi.py. On failure
+they return (or yield) UNAVAILABLE_REPLY, with one exception: a stream that
+breaks after it started raises StreamBroken once its outcome is recorded, so
+the caller can keep the truncated text out of its caches.
+
+Latency (time to first delta for streams, and total), outcomes and the time
+lost on the Responses API before falling back are recorded in /metrics.
+"""
+import logging
+import threading
+import time
+from typing import List, Dict, Any, Iterator, AsyncIterator, Optional
+
+import httpx
+import openai
+from tenacity import (
+    AsyncRetrying,
+    Retrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    stop_after_delay,
+    wait_random_exponential,
+)
+
+from .metrics import registry
+
+log = logging.getLogger(__name__)
+
+UPSTREAM_SECONDS = registry.histogram(
+    "marvel_upstream_seconds",
+    "Model call latency including retries; phase is ttfb (streams), total, or fallback "
+    "(a failed Responses API attempt before switching to chat.completions)",
+    ["model", "api", "phase"])
+UPSTREAM_CALLS = registry.counter(
+    "marvel_upstream_calls_total", "Model calls by outcome (ok, error, broken, breaker_open)",
+    ["model", "api", "outcome"])
+
+UNAVAILABLE_REPLY = (
+    "Mi amor, en este momento no logro conectarme para responderte. "
+    "Respira, repasa tus apuntes un momentico y vuelve a intentarlo en un minuto."
+)
+EMPTY_REPLY = "No pude generar respuesta en este momento."
+
+TRANSIENT_ERRORS = (
+    openai.APIConnectionError,  # includes APITimeoutError
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+# Raised by accounts, proxies or old SDKs without the Responses API
+UNSUPPORTED_API_ERRORS = (openai.NotFoundError, AttributeError)
+# A 400 only means that when it names the endpoint or a parameter as unsupported;
+# any other 400 is a problem with this request and must not switch APIs for good
+UNSUPPORTED_CODES = {"unsupported_parameter", "unsupported_value", "unknown_url", "invalid_request_url"}
+UNSUPPORTED_MARKERS = ("unsupported", "not supported", "unrecognized request url",
+                       "unknown url", "invalid url")
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class StreamBroken(Exception):
+    """The model's stream failed after it started; what was yielded is incomplete."""
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures. While open every call fails
+    fast; after `cooldown` seconds one trial call is let through (half-open),
+    and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                self.opened_at = time.monotonic()  # one trial; others keep failing fast
+                return True
+            return False
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+    @property
+    def state(self) -> str:
+        return "closed" if self.opened_at is None else "open"
+
+
+def _unsupported(exc: Exception) -> bool:
+    if isinstance(exc, UNSUPPORTED_API_ERRORS):
+        return True
+    if not isinstance(exc, openai.BadRequestError):
+        return False
+    if (getattr(exc, "code", None) or "") in UNSUPPORTED_CODES:
+        return True
+    message = str(getattr(exc, "message", "") or exc).lower()
+    return any(marker in message for marker in UNSUPPORTED_MARKERS)
+
+
+def _chat_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    return [{"role": m.get("role", "user"), "content": m.get("content", "")} for m in messages]
+
+
+def _response_text(resp) -> str:
+    try:
+        # helper available in recent SDKs
+        return resp.output_text
+    except Exception:
+        if getattr(resp, "output", None) and resp.output and resp.output[0].content:
+            return "".join(
+                blk.text for blk in resp.output[0].content
+                if getattr(blk, "type", "") == "output_text"
+            )
+        return EMPTY_REPLY
+
+
+class Upstream:
+    def __init__(self, model: str, client=None, aclient=None,
+                 deadline: float = 45.0, attempt_timeout: float = 30.0, max_attempts: int = 3,
+                 breaker: Optional[CircuitBreaker] = None,
+                 connect_timeout: float = 5.0, pool_timeout: float = 10.0):
+        self.model = model
+        self.client = client
+        self.aclient = aclient
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.connect_timeout = connect_timeout
+        self.pool_timeout = pool_timeout
+        self.max_attempts = max_attempts
+        self.breaker = breaker or CircuitBreaker()
+        self.api: Optional[str] = None  # "responses" or "chat" once known
+
+    # --- retry policy ---
+
+    def _retry_kwargs(self) -> Dict[str, Any]:
+        return dict(
+            retry=retry_if_exception_type(TRANSIENT_ERRORS),
+            wait=wait_random_exponential(multiplier=0.5, max=4),
+            stop=stop_after_attempt(self.max_attempts) | stop_after_delay(self.deadline),
+            reraise=True,
+        )
+
+    def _timeout(self, started: float) -> httpx.Timeout:
+        remaining = self.deadline - (time.monotonic() - started)
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        budget = min(self.attempt_timeout, remaining)
+        # Reads get the attempt's budget; connecting and waiting for a pooled
+        # connection have their own, shorter limits
+        return httpx.Timeout(budget, connect=min(self.connect_timeout, budget),
+                             pool=min(self.pool_timeout, budget))
+
+    def _allow(self) -> bool:
+        if self.breaker.allow():
+            return True
+        UPSTREAM_CALLS.inc(model=self.model, api=self.api or "none", outcome="breaker_open")
+        return False
+
+    def _observe(self, started: float, api: str, phase: str) -> None:
+        UPSTREAM_SECONDS.observe(time.perf_counter() - started, model=self.model, api=api, phase=phase)
+
+    def _done(self, api: str, started: float, outcome: str = "ok") -> None:
+        self._observe(started, api, "total")
+        UPSTREAM_CALLS.inc(model=self.model, api=api, outcome=outcome)
+
+    def _fallback(self, exc: Exception) -> bool:
+        """True when the Responses API should be given up for Chat Completions."""
+        if self.api is None and _unsupported(exc):
+            log.info("Responses API unavailable (%s); using chat.completions", exc)
+            self.api = "chat"
+            return True
+        return False
+
+    def _failed(self, exc: Exception) -> None:
+        log.warning("upstream call failed: %r", exc)
+        UPSTREAM_CALLS.inc(model=self.model, api=self.api or "none", outcome="error")
+        if isinstance(exc, TRANSIENT_ERRORS + (DeadlineExceeded,)):
+            self.breaker.failure()
+
+    # --- sync ---
+
+    def _create(self, messages, timeout: httpx.Timeout, stream: bool):
+        if self.api != "chat":
+            tried = time.perf_counter()
+            try:
+                resp = self.client.responses.create(
+                    model=self.model, input=messages, timeout=timeout, stream=stream)
+                self.api = "responses"
+                return "responses", resp
+            except Exception as e:
+                if not self._fallback(e):
+                    raise
+                self._observe(tried, "responses", "fallback")
+        resp = self.client.chat.completions.create(
+            model=self.model, messages=_chat_messages(messages), timeout=timeout, stream=stream)
+        return "chat", resp
+
+    def _open(self, messages, stream: bool):
+        started = time.monotonic()
+        for attempt in Retrying(**self._retry_kwargs()):
+            with attempt:
+                return self._create(messages, self._timeout(started), stream)
+
+    def call(self, messages: List[Dict[str, Any]]) -> str:
+        started = time.perf_counter()
+        if not self._allow():
+            return UNAVAILABLE_REPLY
+        try:
+            api, resp = self._open(messages, stream=False)
+        except Exception as e:
+            self._failed(e)
+            return UNAVAILABLE_REPLY
+        self.breaker.success()
+        self._done(api, started)
+        if api == "responses":
+            return _response_text(resp)
+        return (resp.choices[0].message.content or "").strip() or EMPTY_REPLY
+
+    def stream(self, messages: List[Dict[str, Any]]) -> Iterator[str]:
+        """Yields text deltas; retries happen only before the first one."""
+        started = time.perf_counter()
+        if not self._allow():
+            yield UNAVAILABLE_REPLY
+            return
+        try:
+            api, resp = self._open(messages, stream=True)
+        except Exception as e:
+            self._failed(e)
+            yield UNAVAILABLE_REPLY
+            return
+        self.breaker.success()
+        outcome, first, ended = "ok", True, False
+        try:
+            with resp:
+                for item in resp:
+                    delta = _delta(api, item)
+                    if delta:
+                        if first:
+                            first = False
+                            self._observe(started, api, "ttfb")
+                        yield delta
+                    ended = ended or _ended(api, item)
+            if not ended:
+                # The connection closed without an error, but before the reply was complete
+                raise ConnectionError("stream ended before its final event")
+        except Exception as e:
+            outcome = "broken"
+            log.warning("upstream stream broke: %r", e)
+            raise StreamBroken() from e
+        finally:
+            # Also runs when the caller closes the stream early (word cap, client gone)
+            self._done(api, started, outcome)
+
+    # --- async ---
+
+    async def _acreate(self, messages, timeout: httpx.Timeout, stream: bool):
+        if self.api != "chat":
+            tried = time.perf_counter()
+            try:
+                resp = await self.aclient.responses.create(
+                    model=self.model, input=messages, timeout=timeout, stream=stream)
+                self.api = "responses"
+                return "responses", resp
+            except Exception as e:
+                if not self._fallback(e):
+                    raise
+                self._observe(tried, "responses", "fallback")
+        resp = await self.aclient.chat.completions.create(
+            model=self.model, messages=_chat_messages(messages), timeout=timeout, stream=stream)
+        return "chat", resp
+
+    async def _aopen(self, messages, stream: bool):
+        started = time.monotonic()
+        async for attempt in AsyncRetrying(**self._retry_kwargs()):
+            with attempt:
+                return await self._acreate(messages, self._timeout(started), stream)
+
+    async def acall(self, messages: List[Dict[str, Any]]) -> str:
+        started = time.perf_counter()
+        if not self._allow():
+            return UNAVAILABLE_REPLY
+        try:
+            api, resp = await self._aopen(messages, stream=False)
+        except Exception as e:
+            self._failed(e)
+            return UNAVAILABLE_REPLY
+        self.breaker.success()
+        self._done(api, started)
+        if api == "responses":
+            return _response_text(resp)
+        return (resp.choices[0].message.content or "").strip() or EMPTY_REPLY
+
+    async def astream(self, messages: List[Dict[str, Any]]) -> AsyncIterator[str]:
+        started = time.perf_counter()
+        if not self._allow():
+            yield UNAVAILABLE_REPLY
+            return
+        try:
+            api, resp = await self._aopen(messages, stream=True)
+        except Exception as e:
+            self._failed(e)
+            yield UNAVAILABLE_REPLY
+            return
+        self.breaker.success()
+        outcome, first, ended = "ok", True, False
+        try:
+            async with resp:
+                async for item in resp:
+                    delta = _delta(api, item)
+                    if delta:
+                        if first:
+                            first = False
+                            self._observe(started, api, "ttfb")
+                        yield delta
+                    ended = ended or _ended(api, item)
+            if not ended:
+                # The connection closed without an error, but before the reply was complete
+                raise ConnectionError("stream ended before its final event")
+        except Exception as e:
+            outcome = "broken"
+            log.warning("upstream stream broke: %r", e)
+            raise StreamBroken() from e
+        finally:
+            # Also runs when the caller closes the stream early (word cap, client gone)
+            self._done(api, started, outcome)
+
+
+def _ended(api: str, item) -> bool:
+    """True for the event that closes a complete reply."""
+    if api == "responses":
+        return getattr(item, "type", "") in ("response.completed", "response.incomplete")
+    return bool(item.choices and item.choices[0].finish_reason)
+
+
+def _delta(api: str, item) -> str:
+    if api == "responses":
+        if getattr(item, "type", "") == "response.output_text.delta":
+            return item.delta
+        return ""
+    if item.choices and item.choices[0].delta.content:
+        return item.choices[0].delta.content
+    return ""